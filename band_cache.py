@@ -0,0 +1,95 @@
+import os
+import time
+import sqlite3
+import contextlib
+
+
+class BandCache:
+    # Decoded Sentinel-2 bands stored as tiled, compressed COGs next to their
+    # 65536-bin histogram, keyed by SAFE and band name. An entry is dropped
+    # when the source JP2 changes size or mtime, and the least recently used
+    # entries are evicted beyond max_bytes.
+    def __init__(self, cache_dir, max_bytes=20 * 1024**3):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), isolation_level=None, timeout=60
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS bands (
+                key TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                source_size INTEGER NOT NULL,
+                source_mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """)
+
+    def make_key(self, safe_id, band_path):
+        return f"{safe_id}/{os.path.splitext(os.path.basename(band_path))[0]}"
+
+    def paths(self, key):
+        band_path = os.path.join(self.cache_dir, key + ".tif")
+        return band_path, band_path.replace(".tif", "_hist.npy")
+
+    def lookup(self, safe_id, band_path):
+        key = self.make_key(safe_id, band_path)
+        row = self.connection.execute(
+            "SELECT source_size, source_mtime FROM bands WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        stat = os.stat(band_path)
+        paths = self.paths(key)
+        if tuple(row) != (stat.st_size, stat.st_mtime) or not all(
+            os.path.exists(path) for path in paths
+        ):
+            self.remove(key)
+            return None
+        self.connection.execute(
+            "UPDATE bands SET accessed = ? WHERE key = ?", (time.time(), key)
+        )
+        return paths
+
+    def store(self, safe_id, band_path):
+        # Called once the files at paths(key) are written.
+        key = self.make_key(safe_id, band_path)
+        stat = os.stat(band_path)
+        size = sum(os.path.getsize(path) for path in self.paths(key))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO bands "
+            "(key, source, source_size, source_mtime, size, accessed) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, band_path, stat.st_size, stat.st_mtime, size, time.time()),
+        )
+        self.evict(keep=key)
+
+    def remove(self, key):
+        self.connection.execute("DELETE FROM bands WHERE key = ?", (key,))
+        for path in self.paths(key):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def total_bytes(self):
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bands"
+        ).fetchone()[0]
+
+    def evict(self, keep=None):
+        total = self.total_bytes()
+        rows = self.connection.execute(
+            "SELECT key, size FROM bands ORDER BY accessed"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,86 @@
+import time
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw
+from masks import burn_polygons
+from parcel_store import offsets_from_sizes
+
+
+def random_rings(count, extent, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(4, 12, size=count)
+    width = extent[1] - extent[0]
+    height = extent[3] - extent[2]
+    rings = []
+    for size in sizes:
+        center_x = extent[0] + rng.uniform(0.1, 0.9) * width
+        center_y = extent[2] + rng.uniform(0.1, 0.9) * height
+        angles = np.sort(rng.uniform(0, 2 * np.pi, size - 1))
+        radius = rng.uniform(0.01, 0.08) * width
+        ring = np.column_stack(
+            [center_x + radius * np.cos(angles), center_y + radius * np.sin(angles)]
+        )
+        rings.append(np.vstack([ring, ring[:1]]))
+    return rings
+
+
+def burn_one_by_one(rings, extent, resolution):
+    mask_data = np.zeros((resolution[1], resolution[0]), dtype=np.uint8)
+    for ring in rings:
+        poly_x, poly_y = zip(*ring)
+        poly_x = [
+            (x - extent[0]) / (extent[1] - extent[0]) * resolution[0] for x in poly_x
+        ]
+        poly_y = [
+            (resolution[1] - (y - extent[2]) / (extent[3] - extent[2]) * resolution[1])
+            for y in poly_y
+        ]
+        mask_image = Image.new("L", resolution, 0)
+        draw = ImageDraw.Draw(mask_image)
+        draw.polygon(list(zip(poly_x, poly_y)), outline=1, fill=1)
+        mask_data = np.maximum(mask_data, np.array(mask_image))
+    return mask_data
+
+
+def measure(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--polygons",
+        type=int,
+        default=200,
+        help="Number of parcels drawn into one tile.",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Number of timed runs."
+    )
+    args = parser.parse_args()
+
+    extent = (126.47, 126.4828, 34.63, 34.6428)
+    resolution = (128, 128)
+    rings = random_rings(args.polygons, extent)
+    coords = np.concatenate(rings)
+    offsets = offsets_from_sizes([len(ring) for ring in rings])
+
+    old_time, old_mask = measure(
+        lambda: burn_one_by_one(rings, extent, resolution), args.repeat
+    )
+    new_time, new_mask = measure(
+        lambda: burn_polygons(coords, offsets[:-1], offsets[1:], extent, resolution),
+        args.repeat,
+    )
+
+    print(f"one image per polygon: {old_time * 1000:.2f} ms")
+    print(f"single buffer:         {new_time * 1000:.2f} ms")
+    print(
+        f"speedup: {old_time / new_time:.1f}x, identical: {(old_mask == new_mask).all()}"
+    )
@@ -1,8 +1,17 @@
+import io
 import os
 import shutil
+import asyncio
 import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from tile_store import TileStore
+from review_queue import ReviewQueue
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -11,90 +20,229 @@ from telegram.ext import (
 )
 
 
-def convert_tif_to_png(compression_level=6):
-    tif_files = [f for f in os.listdir(tif_dir) if f.endswith(".tif")]
-    print(
-        f"Converting {len(tif_files)} .tifs to .pngs and compressing them. Please wait a moment..."
-    )
+class PngRenderer:
+    # Renders tiles to PNG in image_dir the first time they are needed, and
+    # ahead of time for the next items in a thread pool. At most max_files
+    # PNGs are kept, the least recently used ones are deleted first.
+    def __init__(
+        self,
+        image_dir,
+        tif_dir,
+        store_dir=None,
+        max_files=2000,
+        workers=4,
+        compression_level=6,
+    ):
+        self.image_dir = image_dir
+        self.tif_dir = tif_dir
+        self.max_files = max_files
+        self.compression_level = compression_level
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.rendered = OrderedDict(
+            (f, None)
+            for f in sorted(
+                (f for f in os.listdir(image_dir) if f.endswith(".png")),
+                key=lambda f: os.path.getmtime(os.path.join(image_dir, f)),
+            )
+        )
+        self.tile_store = TileStore(store_dir) if store_dir else None
+        if self.tile_store:
+            self.rows = {
+                self.tile_store.name(row) + ".png": row
+                for row in range(len(self.tile_store))
+            }
+        else:
+            self.rows = {
+                f.replace(".tif", ".png"): None
+                for f in os.listdir(tif_dir)
+                if f.endswith(".tif")
+            }
+
+    def __contains__(self, filename):
+        return filename in self.rows
+
+    def render(self, filename):
+        png_path = os.path.join(self.image_dir, filename)
+        try:
+            if not os.path.exists(png_path):
+                if self.tile_store:
+                    tile = self.tile_store.tiles[self.rows[filename]]
+                    image = Image.fromarray(np.moveaxis(tile, 0, -1))
+                else:
+                    image = Image.open(
+                        os.path.join(self.tif_dir, filename.replace(".png", ".tif"))
+                    )
+                with image:
+                    image.save(
+                        png_path + ".part",
+                        "PNG",
+                        compress_level=self.compression_level,
+                    )
+                os.replace(png_path + ".part", png_path)
+        except BaseException:
+            # Forget the failed future, so the next submit renders again.
+            with self.lock:
+                self.futures.pop(filename, None)
+            raise
+        with self.lock:
+            self.futures.pop(filename, None)
+            self.rendered[filename] = None
+            self.rendered.move_to_end(filename)
+            while len(self.rendered) > self.max_files:
+                old_filename, _ = self.rendered.popitem(last=False)
+                if os.path.exists(os.path.join(self.image_dir, old_filename)):
+                    os.remove(os.path.join(self.image_dir, old_filename))
+        return png_path
+
+    def submit(self, filename):
+        with self.lock:
+            future = self.futures.get(filename)
+            if future is None:
+                future = self.executor.submit(self.render, filename)
+                self.futures[filename] = future
+            return future
+
+    def prefetch(self, filenames):
+        for filename in filenames:
+            if filename not in self.rendered:
+                self.submit(filename)
+
+    async def path(self, filename):
+        return await asyncio.wrap_future(self.submit(filename))
+
 
-    for tif_file in tif_files:
-        tif_path = os.path.join(tif_dir, tif_file)
-        png_path = os.path.join(image_dir, tif_file.replace(".tif", ".png"))
+def compose_preview(image_path, mask_path, preview="side"):
+    # One PNG per item: the tile next to its mask, or the mask blended in red
+    # over the tile.
+    with Image.open(image_path) as image:
+        tile = np.asarray(image.convert("RGB"))
+    with Image.open(mask_path) as mask_image:
+        mask = np.asarray(mask_image) > 0
+    if preview == "overlay":
+        composite = tile.astype(np.float32)
+        composite[mask] = 0.6 * composite[mask] + 0.4 * np.array([255, 0, 0])
+        composite = composite.astype(np.uint8)
+    else:
+        mask_rgb = np.repeat(mask[..., None] * np.uint8(255), 3, axis=2)
+        composite = np.concatenate([tile, mask_rgb], axis=1)
+    buffer = io.BytesIO()
+    Image.fromarray(composite).save(buffer, "PNG")
+    buffer.seek(0)
+    return buffer
 
-        with Image.open(tif_path) as img:
-            img.save(png_path, "PNG", compress_level=compression_level)
 
-    print(f"Converted and compressed {len(tif_files)} .tif files to .png format.")
+renderer = None
+queue = None
 
+# callback action -> (review state, reply)
+ACTIONS = {
+    "keep": ("kept", "Keeping"),
+    "move": ("unclear", "Removing"),
+    "later": ("later", "To be processed later"),
+}
 
-processing_files = {}
 
+def decision_dirs():
+    return {"kept": clean_dir, "unclear": unclear_dir, "later": later_dir}
 
-def get_files():
-    images = [f for f in os.listdir(image_dir) if f.endswith(".png")]
-    masks = [f for f in os.listdir(mask_dir) if f.endswith(".png")]
-    images_with_masks = [f for f in images if f in masks]
-    print(len(images_with_masks))
-    return images_with_masks
+
+def find_mask(filename):
+    # Items sent to "later" keep their mask in later_dir until re-reviewed.
+    for directory in (mask_dir, later_dir):
+        if os.path.exists(os.path.join(directory, filename)):
+            return os.path.join(directory, filename)
+    return None
+
+
+def sync_queue():
+    masks = {f for f in os.listdir(mask_dir) if f.endswith(".png")}
+    # Decisions are committed before the mask is moved, so finish moves that
+    # were interrupted by a crash.
+    for state, target_dir in decision_dirs().items():
+        for source_dir in (mask_dir, later_dir):
+            if source_dir == target_dir:
+                continue
+            for filename in set(os.listdir(source_dir)).intersection(
+                queue.items(state)
+            ):
+                shutil.move(
+                    os.path.join(source_dir, filename),
+                    os.path.join(target_dir, filename),
+                )
+                masks.discard(filename)
+    queue.sync(f for f in masks if f in renderer)
+    print(f"Review queue: {queue.summary()}")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["files"] = get_files()
+    context.chat_data["states"] = ("pending",)
+    await send_next_image_and_mask(update, context, update.message.chat_id)
+
+
+async def later(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Re-review the items sent to "later", their previews are re-sent by
+    # Telegram file_id without uploading them again.
+    context.chat_data["states"] = ("later",)
     await send_next_image_and_mask(update, context, update.message.chat_id)
 
 
+async def send_preview(context, chat_id, filename, mask_path, reply_markup):
+    caption = f"Image and Mask: {filename}"
+    file_id = queue.file_id(filename, preview)
+    if file_id:
+        try:
+            return await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup,
+            )
+        except BadRequest as e:
+            print(f"Uploading {filename} again, file_id was rejected: {e}")
+
+    image_path = await renderer.path(filename)
+    renderer.prefetch(queue.upcoming(prefetch))
+    photo = await asyncio.to_thread(compose_preview, image_path, mask_path, preview)
+    message = await context.bot.send_photo(
+        chat_id=chat_id,
+        photo=photo,
+        caption=caption,
+        reply_markup=reply_markup,
+    )
+    queue.set_file_id(filename, preview, message.photo[-1].file_id)
+    return message
+
+
 async def send_next_image_and_mask(
     update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id
 ):
-    files = context.user_data.get("files", [])
-    while files:
-        filename = files.pop(0)
-        image_path = os.path.join(image_dir, filename)
-        mask_path = os.path.join(mask_dir, filename)
-
-        if (
-            os.path.exists(image_path)
-            and os.path.exists(mask_path)
-            and filename not in processing_files
-        ):
-            processing_files[filename] = chat_id
-            context.user_data["files"] = files
-            keyboard = [
-                [
-                    InlineKeyboardButton("Keep", callback_data=f"keep:{filename}"),
-                    InlineKeyboardButton("Unclear", callback_data=f"move:{filename}"),
-                    InlineKeyboardButton(
-                        "Confusing", callback_data=f"later:{filename}"
-                    ),
-                ]
+    states = context.chat_data.get("states", ("pending",))
+    while (filename := queue.claim_next(chat_id, states=states)) is not None:
+        mask_path = find_mask(filename)
+        if filename not in renderer or mask_path is None:
+            queue.remove(filename)
+            continue
+
+        keyboard = [
+            [
+                InlineKeyboardButton("Keep", callback_data=f"keep:{filename}"),
+                InlineKeyboardButton("Unclear", callback_data=f"move:{filename}"),
+                InlineKeyboardButton("Confusing", callback_data=f"later:{filename}"),
             ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            try:
-                with (
-                    open(image_path, "rb") as image_file,
-                    open(mask_path, "rb") as mask_file,
-                ):
-                    media_group = [
-                        InputMediaPhoto(media=image_file),
-                        InputMediaPhoto(media=mask_file),
-                    ]
-                    await context.bot.send_media_group(
-                        chat_id=chat_id, media=media_group
-                    )
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Image and Mask: {filename}",
-                    reply_markup=reply_markup,
-                )
-                return
-            except Exception as e:
-                print(f"Failed to send image or mask: {e}")
-                await context.bot.send_message(
-                    chat_id=chat_id, text=f"Failed to process image or mask: {e}"
-                )
-        else:
-            context.user_data["files"] = files
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        try:
+            await send_preview(context, chat_id, filename, mask_path, reply_markup)
+            return
+        except Exception as e:
+            print(f"Failed to send image or mask: {e}")
+            queue.fail(filename, chat_id, e, states[0], max_attempts)
+            await context.bot.send_message(
+                chat_id=chat_id, text=f"Failed to process image or mask: {e}"
+            )
 
     await context.bot.send_message(chat_id=chat_id, text="No images or masks found.")
 
@@ -103,34 +251,20 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     action, filename = query.data.split(":")
+    state, reply = ACTIONS[action]
 
-    if (
-        filename not in processing_files
-        or processing_files[filename] != query.message.chat_id
-    ):
-        await query.edit_message_text(
-            text="This image is already processed or not assigned to you."
+    if not queue.finish(filename, query.message.chat_id, state):
+        await query.edit_message_caption(
+            caption="This image is already processed or not assigned to you."
         )
         return
 
     try:
-        if action == "move":
-            shutil.move(
-                os.path.join(mask_dir, filename), os.path.join(unclear_dir, filename)
-            )
-            await query.edit_message_text(text=f"Removing: {filename}")
-        elif action == "keep":
-            shutil.move(
-                os.path.join(mask_dir, filename), os.path.join(clean_dir, filename)
-            )
-            await query.edit_message_text(text=f"Keeping: {filename}")
-        elif action == "later":
-            shutil.move(
-                os.path.join(mask_dir, filename), os.path.join(later_dir, filename)
-            )
-            await query.edit_message_text(text=f"To be processed later: {filename}")
-
-        del processing_files[filename]
+        mask_path = find_mask(filename)
+        target_path = os.path.join(decision_dirs()[state], filename)
+        if mask_path != target_path:
+            shutil.move(mask_path, target_path)
+        await query.edit_message_caption(caption=f"{reply}: {filename}")
         await send_next_image_and_mask(query, context, query.message.chat_id)
     except Exception as e:
         print(f"Failed to move or copy image: {e}")
@@ -140,17 +274,23 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def main():
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir)
-        convert_tif_to_png()
+    global renderer, queue
+    os.makedirs(image_dir, exist_ok=True)
+    renderer = PngRenderer(
+        image_dir, tif_dir, store_dir=tile_store_dir, max_files=max_pngs
+    )
 
     os.makedirs(clean_dir, exist_ok=True)
     os.makedirs(unclear_dir, exist_ok=True)
     os.makedirs(later_dir, exist_ok=True)
 
+    queue = ReviewQueue(queue_path, lease_seconds=lease_minutes * 60)
+    sync_queue()
+
     application = ApplicationBuilder().token(TOKEN).build()
 
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("later", later))
     application.add_handler(CallbackQueryHandler(button))
 
     application.run_polling()
@@ -168,14 +308,63 @@ if __name__ == "__main__":
     parser.add_argument(
         "-t", "--token", type=str, required=True, help="Your telegram bot Token."
     )
+    parser.add_argument(
+        "-i",
+        "--tile_store",
+        action="store_true",
+        help="Read the tiles from ./data/tiles/<safe>.tiles instead of .tif files.",
+    )
+    parser.add_argument(
+        "-p",
+        "--prefetch",
+        type=int,
+        default=8,
+        help="Number of upcoming tiles rendered to PNG ahead of time.",
+    )
+    parser.add_argument(
+        "-m",
+        "--max_pngs",
+        type=int,
+        default=2000,
+        help="Number of rendered PNGs kept on disk.",
+    )
+    parser.add_argument(
+        "-l",
+        "--lease_minutes",
+        type=float,
+        default=30,
+        help="Minutes before an unanswered item goes back to the queue.",
+    )
+    parser.add_argument(
+        "-a",
+        "--max_attempts",
+        type=int,
+        default=3,
+        help="Failed sends before an item is parked as failed.",
+    )
+    parser.add_argument(
+        "-v",
+        "--preview",
+        type=str,
+        default="side",
+        choices=["side", "overlay"],
+        help="Send the tile next to its mask, or the mask blended over the tile.",
+    )
     args = parser.parse_args()
 
     TOKEN = args.token
     tif_dir = os.path.join("./data/tiles", args.safe_name)
+    tile_store_dir = tif_dir + ".tiles" if args.tile_store else None
+    prefetch = args.prefetch
+    max_pngs = args.max_pngs
     mask_dir = os.path.join("./data/bot_filter/masks", args.safe_name)
     image_dir = os.path.join("./data/bot_filter/pngs", args.safe_name)
     clean_dir = os.path.join("./data/bot_filter/clear_masks", args.safe_name)
     unclear_dir = os.path.join("./data/bot_filter/unclear_masks", args.safe_name)
     later_dir = os.path.join("./data/bot_filter/later", args.safe_name)
+    queue_path = os.path.join("./data/bot_filter", args.safe_name + "_queue.sqlite")
+    lease_minutes = args.lease_minutes
+    max_attempts = args.max_attempts
+    preview = args.preview
 
     main()
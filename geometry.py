@@ -0,0 +1,174 @@
+import numpy as np
+
+# Rings are closed lists of [x, y] (lon, lat) points and bboxes follow the
+# (y_min, x_min, y_max, x_max) order used by the V-World queries.
+
+
+def bbox_ring(bbox):
+    y_min, x_min, y_max, x_max = bbox
+    return [
+        [x_min, y_min],
+        [x_max, y_min],
+        [x_max, y_max],
+        [x_min, y_max],
+        [x_min, y_min],
+    ]
+
+
+def convex_hull(points):
+    # Andrew's monotone chain, returns a closed counter-clockwise ring.
+    points = np.unique(np.asarray(points, dtype=np.float64), axis=0).tolist()
+    if len(points) < 3:
+        return points + points[:1]
+
+    def half(points):
+        chain = []
+        for point in points:
+            while len(chain) >= 2 and cross(chain[-2], chain[-1], point) <= 0:
+                chain.pop()
+            chain.append(point)
+        return chain
+
+    lower = half(points)
+    upper = half(reversed(points))
+    return lower[:-1] + upper[:-1] + lower[:1]
+
+
+def cross(origin, a, b):
+    return (a[0] - origin[0]) * (b[1] - origin[1]) - (a[1] - origin[1]) * (
+        b[0] - origin[0]
+    )
+
+
+def ring_intersects_bbox(ring, bbox):
+    # Separating axis test, valid for convex counter-clockwise rings such as
+    # the ones from convex_hull and bbox_ring. Touching does not count.
+    y_min, x_min, y_max, x_max = bbox
+    xs = [point[0] for point in ring]
+    ys = [point[1] for point in ring]
+    if max(xs) <= x_min or min(xs) >= x_max or max(ys) <= y_min or min(ys) >= y_max:
+        return False
+    corners = ((x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max))
+    for start, end in zip(ring, ring[1:]):
+        if start == end:
+            continue
+        if all(cross(start, end, corner) <= 0 for corner in corners):
+            return False
+    return True
+
+
+def snap_ring(ring, grid):
+    # Rounds to multiples of grid and drops the vertices that became repeats.
+    snapped = np.round(ring / grid) * grid
+    keep = np.concatenate(([True], (np.diff(snapped, axis=0) != 0).any(axis=1)))
+    snapped = snapped[keep]
+    return snapped if len(snapped) >= 4 else ring
+
+
+def segment_distances(ring, start, end):
+    # Distances of the vertices between start and end to the segment joining them.
+    segment = ring[end] - ring[start]
+    points = ring[start + 1 : end] - ring[start]
+    length = np.hypot(*segment)
+    if not length:
+        return np.hypot(points[:, 0], points[:, 1])
+    return np.abs(segment[0] * points[:, 1] - segment[1] * points[:, 0]) / length
+
+
+def douglas_peucker(ring, tolerance):
+    # Closed rings are split at the vertex farthest from the first one.
+    # Returns a mask of the vertices to keep.
+    keep = np.zeros(len(ring), dtype=bool)
+    far = int(np.argmax(((ring - ring[0]) ** 2).sum(axis=1)))
+    keep[[0, far, len(ring) - 1]] = True
+    stack = [(0, far), (far, len(ring) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        distances = segment_distances(ring, start, end)
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            middle = start + 1 + index
+            keep[middle] = True
+            stack.extend([(start, middle), (middle, end)])
+    return keep
+
+
+def crossing_segments(rings, block_size=256):
+    # Segment i of a ring runs from vertex i to i + 1. Returns, per ring, the
+    # segments that cross or touch a segment other than their neighbours, or
+    # that fold back onto their successor.
+    starts = np.concatenate([ring[:-1] for ring in rings])
+    ends = np.concatenate([ring[1:] for ring in rings])
+    ring_ids = np.repeat(np.arange(len(rings)), [len(ring) - 1 for ring in rings])
+    segment_ids = np.concatenate([np.arange(len(ring) - 1) for ring in rings])
+    sizes = np.array([len(ring) - 1 for ring in rings])[ring_ids]
+    crossing = np.zeros(len(starts), dtype=bool)
+
+    def orientation(a, b, c):
+        return (b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) - (
+            b[..., 1] - a[..., 1]
+        ) * (c[..., 0] - a[..., 0])
+
+    lower = np.minimum(starts, ends)
+    upper = np.maximum(starts, ends)
+    for first in range(0, len(starts), block_size):
+        rows = slice(first, first + block_size)
+        p, q = starts[rows, None], ends[rows, None]
+        hits = (
+            (orientation(starts, ends, p) * orientation(starts, ends, q) <= 0)
+            & (orientation(p, q, starts) * orientation(p, q, ends) <= 0)
+            & (lower[rows, None] <= upper).all(axis=2)
+            & (upper[rows, None] >= lower).all(axis=2)
+        )
+        same_ring = ring_ids[rows, None] == ring_ids
+        gap = np.abs(segment_ids[rows, None] - segment_ids)
+        neighbours = same_ring & ((gap <= 1) | (gap == sizes[rows, None] - 1))
+        crossing[rows] |= (hits & ~neighbours).any(axis=1)
+
+    following = np.where(segment_ids == sizes - 1, -(sizes - 1), 1) + np.arange(
+        len(starts)
+    )
+    direction = ends - starts
+    next_direction = direction[following]
+    folds = (
+        direction[:, 0] * next_direction[:, 1] - direction[:, 1] * next_direction[:, 0]
+        == 0
+    ) & ((direction * next_direction).sum(axis=1) < 0)
+    crossing |= folds
+    crossing[following[folds]] = True
+    return [segment_ids[(ring_ids == ring) & crossing] for ring in range(len(rings))]
+
+
+def simplify_rings(rings, tolerance):
+    # Douglas-Peucker on the closed rings of one polygon that never lets a
+    # ring cross itself or another ring: while simplified segments cross, the
+    # vertex farthest from each crossing segment is put back. Rings that would
+    # drop below a triangle are kept as they are.
+    keeps = [
+        (
+            douglas_peucker(ring, tolerance)
+            if len(ring) > 4
+            else np.ones(len(ring), dtype=bool)
+        )
+        for ring in rings
+    ]
+    while True:
+        simplified = [ring[keep] for ring, keep in zip(rings, keeps)]
+        restored = False
+        for ring, keep, segments in zip(rings, keeps, crossing_segments(simplified)):
+            kept = np.flatnonzero(keep)
+            for segment in segments:
+                start, end = kept[segment], kept[segment + 1]
+                if end - start >= 2:
+                    keep[
+                        start + 1 + int(np.argmax(segment_distances(ring, start, end)))
+                    ] = True
+                    restored = True
+        if not restored:
+            break
+    return [
+        ring if len(ring) < 4 or keep.sum() < 4 else ring[keep]
+        for ring, keep in zip(rings, keeps)
+    ]
@@ -0,0 +1,111 @@
+import os
+import glob
+import time
+import sqlite3
+
+
+class CrawlManifest:
+    # One row per planned page. A page is "pending" until it is fetched, then
+    # "done" (response file written), "empty" (no rice paddies in it) or
+    # "failed" (kept in the retry queue for the next attempt or --resume run).
+    def __init__(self, path):
+        self.directory = os.path.dirname(path)
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                file_number INTEGER PRIMARY KEY,
+                bbox TEXT NOT NULL,
+                start_index INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                byte_count INTEGER,
+                feature_count INTEGER,
+                kept_count INTEGER,
+                error TEXT,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS pages_state ON pages (state);
+            """)
+
+    def get_meta(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def reset(self, bbox, pages):
+        # Response files of an earlier plan do not match the new file numbers.
+        for file_path in glob.glob(os.path.join(self.directory, "response_*.npz*")):
+            os.remove(file_path)
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM pages")
+            self.connection.executemany(
+                "INSERT INTO pages (file_number, bbox, start_index, updated) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        file_number,
+                        ",".join(str(value) for value in cell),
+                        start,
+                        time.time(),
+                    )
+                    for file_number, (cell, start) in enumerate(pages)
+                ],
+            )
+            self.set_meta("bbox", bbox)
+
+    def pages(self, states=("pending", "failed")):
+        rows = self.connection.execute(
+            f"SELECT file_number, bbox, start_index FROM pages "
+            f"WHERE state IN ({','.join('?' * len(states))}) ORDER BY file_number",
+            states,
+        ).fetchall()
+        return [
+            (file_number, tuple(float(value) for value in bbox.split(",")), start)
+            for file_number, bbox, start in rows
+        ]
+
+    def mark(
+        self,
+        file_number,
+        state,
+        byte_count=None,
+        feature_count=None,
+        kept_count=None,
+        error=None,
+    ):
+        self.connection.execute(
+            "UPDATE pages SET state = ?, attempts = attempts + 1, byte_count = ?, "
+            "feature_count = ?, kept_count = ?, error = ?, updated = ? "
+            "WHERE file_number = ?",
+            (
+                state,
+                byte_count,
+                feature_count,
+                kept_count,
+                error,
+                time.time(),
+                file_number,
+            ),
+        )
+
+    def summary(self):
+        return dict(
+            self.connection.execute(
+                "SELECT state, COUNT(*) FROM pages GROUP BY state"
+            ).fetchall()
+        )
+
+    def close(self):
+        self.connection.close()
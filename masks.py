@@ -1,113 +1,399 @@
 import os
 import json
 import shutil
+import hashlib
 import argparse
+import multiprocessing
 import rasterio
 from rasterio.plot import plotting_extent
 from rasterio.transform import from_bounds
 from rasterio.enums import Resampling
 import numpy as np
 from PIL import Image, ImageDraw
+from parcel_store import ParcelStore, import_json_dir, expand_ranges, parcel_keys
+from tile_store import TileStore, add_array
 
 
 def extract_number(filename):
     return int(os.path.splitext(filename.split("_")[-1])[0])
 
 
+def get_parcel_store(json_dir):
+    store_dir = os.path.join(json_dir, "parcels")
+    if not os.path.isdir(store_dir):
+        import_json_dir(json_dir, store_dir)
+    return ParcelStore(store_dir)
+
+
 def get_polygons_list(json_dir):
-    polygons_list = []
-    for json_file in os.listdir(json_dir):
-        if json_file.endswith(".json"):
-            with open(os.path.join(json_dir, json_file)) as f:
-                data = json.load(f)
-                polygons_list.extend(
-                    [
-                        feature["geometry"]["coordinates"][0][0]
-                        for feature in data["features"]
+    return get_parcel_store(json_dir).exteriors()
+
+
+class ParcelGrid:
+    # Uniform grid over the parcels keyed by the lower-left corner of their
+    # bbox. With cells as large as a tile, every parcel fully inside a tile
+    # extent has its corner in one of the (at most 2x2) cells under the tile.
+    def __init__(self, bboxes, cell_size):
+        self.bboxes = np.asarray(bboxes, dtype=np.float64)
+        self.cell_size = cell_size
+        if not len(self.bboxes):
+            self.origin = np.zeros(2)
+            self.shape = np.ones(2, dtype=np.int64)
+            self.order = np.empty(0, dtype=np.int64)
+            self.starts = np.zeros(2, dtype=np.int64)
+            return
+        self.origin = self.bboxes[:, :2].min(axis=0)
+        cells = np.floor((self.bboxes[:, :2] - self.origin) / cell_size).astype(
+            np.int64
+        )
+        self.shape = cells.max(axis=0) + 1
+        keys = cells[:, 1] * self.shape[0] + cells[:, 0]
+        self.order = np.argsort(keys, kind="stable")
+        self.starts = np.searchsorted(
+            keys[self.order], np.arange(self.shape[0] * self.shape[1] + 1)
+        )
+
+    def query(self, extent):
+        left, right, bottom, top = extent
+        x0, y0 = np.floor((np.array([left, bottom]) - self.origin) / self.cell_size)
+        x1, y1 = np.floor((np.array([right, top]) - self.origin) / self.cell_size)
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1 = min(int(x1), self.shape[0] - 1)
+        y1 = min(int(y1), self.shape[1] - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+
+        candidates = np.concatenate(
+            [
+                self.order[
+                    self.starts[row * self.shape[0] + x0] : self.starts[
+                        row * self.shape[0] + x1 + 1
                     ]
-                )
-    return polygons_list
+                ]
+                for row in range(y0, y1 + 1)
+            ]
+        )
+        bboxes = self.bboxes[candidates]
+        inside = (
+            (bboxes[:, 0] >= left)
+            & (bboxes[:, 2] <= right)
+            & (bboxes[:, 1] >= bottom)
+            & (bboxes[:, 3] <= top)
+        )
+        return np.sort(candidates[inside])
 
 
-def draw_polygons(
-    tiles_dir: str, masks_dir: str, miscs_dir: str, json_dir: str
-) -> None:
-    polygons_list = get_polygons_list(json_dir=json_dir)
-    sorted_tiles = sorted(
-        [file for file in os.listdir(tiles_dir) if file.endswith(".tif")],
-        key=extract_number,
-    )
-    existing_masks = sorted(
-        [file for file in os.listdir(masks_dir) if file.endswith(".tif")],
-        key=extract_number,
+def to_pixels(coords, extent, resolution):
+    pixels = np.empty_like(coords)
+    pixels[:, 0] = (coords[:, 0] - extent[0]) / (extent[1] - extent[0]) * resolution[0]
+    pixels[:, 1] = (
+        resolution[1]
+        - (coords[:, 1] - extent[2]) / (extent[3] - extent[2]) * resolution[1]
     )
+    return pixels
 
-    last_processed_index = 0
-    if existing_masks:
-        last_processed_index = extract_number(existing_masks[-1])
 
-    for image_file in sorted_tiles[last_processed_index:]:
-        image_path = os.path.join(tiles_dir, image_file)
-        mask_image_path = os.path.join(masks_dir, image_file)
-        misc_image_path = os.path.join(miscs_dir, image_file)
+def burn_polygons(coords, starts, ends, extent, resolution, values=None):
+    # All rings of a tile are gathered and moved to pixel space in one NumPy
+    # step and drawn into a single buffer. With values=None the mask is 0/1,
+    # otherwise each ring is filled with its value (e.g. a parcel instance ID).
+    vertices = expand_ranges(starts, ends)
+    flat = to_pixels(coords[vertices], extent, resolution).ravel().tolist()
+    bounds = np.concatenate(([0], np.cumsum(ends - starts) * 2)).tolist()
+
+    mask_image = Image.new("L" if values is None else "I", resolution, 0)
+    draw = ImageDraw.Draw(mask_image)
+    for i in range(len(starts)):
+        value = 1 if values is None else int(values[i])
+        draw.polygon(flat[bounds[i] : bounds[i + 1]], outline=value, fill=value)
+    return np.array(mask_image)
+
+
+class TileRasterizer:
+    def __init__(self, store, instance_ids=False):
+        self.coords = np.asarray(store.coords)
+        self.keys = parcel_keys(store.arrays)
+        self.exterior_starts, self.exterior_ends = store.exterior_ranges()
+        self.exterior_bboxes = store.exterior_bboxes()
+        self.instance_ids = instance_ids
+        self.grid = None
 
+    def query(self, extent):
+        if self.grid is None:
+            self.grid = ParcelGrid(
+                self.exterior_bboxes, cell_size=extent[1] - extent[0]
+            )
+        return self.grid.query(extent)
+
+    def parcel_digest(self, indices):
+        # Covers the parcel keys and their exterior rings, so a refetch that
+        # changes geometry under an unchanged ID also invalidates the tile.
+        # Instance IDs follow the store order, so they are part of it too.
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str(self.instance_ids).encode())
+        digest.update("\n".join(self.keys[indices]).encode())
+        if self.instance_ids:
+            digest.update(indices.tobytes())
+        vertices = expand_ranges(
+            self.exterior_starts[indices], self.exterior_ends[indices]
+        )
+        digest.update(self.coords[vertices].tobytes())
+        return digest.hexdigest()
+
+    def burn(self, extent, resolution):
+        indices = self.query(extent)
+        if not len(indices):
+            return None
+        return burn_polygons(
+            self.coords,
+            self.exterior_starts[indices],
+            self.exterior_ends[indices],
+            extent,
+            resolution,
+            values=indices + 1 if self.instance_ids else None,
+        )
+
+    def draw(self, image_path, mask_image_path, misc_image_path):
         with rasterio.open(image_path) as src:
             extent = plotting_extent(src)
             original_resolution = (src.width, src.height)
             transform = src.transform
             crs = src.crs
 
-        mask_data = np.zeros(
-            (original_resolution[1], original_resolution[0]), dtype=np.uint8
+        mask_data = self.burn(extent, original_resolution)
+        if mask_data is None:
+            shutil.copy2(image_path, misc_image_path)
+            remove_file(mask_image_path)
+            return False
+
+        with rasterio.open(
+            mask_image_path,
+            "w",
+            driver="GTiff",
+            height=original_resolution[1],
+            width=original_resolution[0],
+            count=1,
+            dtype=mask_data.dtype,
+            crs=crs,
+            transform=transform,
+        ) as dst:
+            dst.write(mask_data, 1)
+        remove_file(misc_image_path)
+        return True
+
+
+def tile_extent(image_path):
+    with rasterio.open(image_path) as src:
+        return plotting_extent(src)
+
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def load_mask_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def save_mask_index(index_path, mask_index):
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(mask_index, f)
+    os.replace(index_path + ".tmp", index_path)
+
+
+rasterizer = None
+
+
+def init_worker(store_dir, instance_ids):
+    # Workers map the parcel store files themselves, so the coordinate and
+    # offset arrays are shared through the page cache instead of being pickled.
+    global rasterizer
+    rasterizer = TileRasterizer(ParcelStore(store_dir), instance_ids=instance_ids)
+
+
+def draw_tile(task):
+    image_file, paths = task
+    return image_file, rasterizer.draw(*paths)
+
+
+def draw_polygons(
+    tiles_dir: str,
+    masks_dir: str,
+    miscs_dir: str,
+    json_dir: str,
+    instance_ids: bool = False,
+    workers: int = 1,
+) -> None:
+    # masks_dir/mask_index.json remembers, per tile, a hash of the tile file
+    # and of the parcels inside it, and whether it ended up as a mask or a
+    # misc. Only tiles where either hash changed or the output is missing are
+    # drawn again.
+    store = get_parcel_store(json_dir=json_dir)
+    tile_rasterizer = TileRasterizer(store, instance_ids=instance_ids)
+    index_path = os.path.join(masks_dir, "mask_index.json")
+    mask_index = load_mask_index(index_path)
+
+    sorted_tiles = sorted(
+        [file for file in os.listdir(tiles_dir) if file.endswith(".tif")],
+        key=extract_number,
+    )
+    tasks = []
+    entries = {}
+    for image_file in sorted_tiles:
+        image_path = os.path.join(tiles_dir, image_file)
+        entry = {
+            "tile": file_digest(image_path),
+            "parcels": tile_rasterizer.parcel_digest(
+                tile_rasterizer.query(tile_extent(image_path))
+            ),
+        }
+        previous = mask_index.get(image_file)
+        if previous and all(previous[key] == entry[key] for key in entry):
+            output_dir = masks_dir if previous["mask"] else miscs_dir
+            if os.path.exists(os.path.join(output_dir, image_file)):
+                continue
+        entries[image_file] = entry
+        tasks.append(
+            (
+                image_file,
+                (
+                    image_path,
+                    os.path.join(masks_dir, image_file),
+                    os.path.join(miscs_dir, image_file),
+                ),
+            )
         )
 
-        polygons_drawn = False
-        for polygon_coords in polygons_list:
-            poly_x, poly_y = zip(*polygon_coords)
-            if (
-                min(poly_x) >= extent[0]
-                and max(poly_x) <= extent[1]
-                and min(poly_y) >= extent[2]
-                and max(poly_y) <= extent[3]
-            ):
-                poly_x = [
-                    (x - extent[0]) / (extent[1] - extent[0]) * original_resolution[0]
-                    for x in poly_x
-                ]
-                poly_y = [
-                    (
-                        original_resolution[1]
-                        - (y - extent[2])
-                        / (extent[3] - extent[2])
-                        * original_resolution[1]
-                    )
-                    for y in poly_y
-                ]
-                polygon_coords_transformed = list(zip(poly_x, poly_y))
+    for image_file in set(mask_index) - set(sorted_tiles):
+        del mask_index[image_file]
+    print(
+        f"Skipping {len(sorted_tiles) - len(tasks)} unchanged tiles, "
+        f"drawing {len(tasks)} of {len(sorted_tiles)}"
+    )
+
+    def record(results):
+        for done, (image_file, drawn) in enumerate(results, 1):
+            mask_index[image_file] = {**entries[image_file], "mask": drawn}
+            if done % 500 == 0:
+                save_mask_index(index_path, mask_index)
+
+    if workers > 1:
+        with multiprocessing.Pool(
+            workers,
+            initializer=init_worker,
+            initargs=(os.path.join(json_dir, "parcels"), instance_ids),
+        ) as pool:
+            record(pool.imap_unordered(draw_tile, tasks, chunksize=16))
+    else:
+        record(
+            (image_file, tile_rasterizer.draw(*paths)) for image_file, paths in tasks
+        )
+    save_mask_index(index_path, mask_index)
+
+
+def draw_polygons_to_store(store_dir: str, json_dir: str, instance_ids: bool = False):
+    # Adds a masks array to a tile store written by tiles.py --tile_store.
+    # Tiles without parcels get an all-zero mask instead of going to miscs.
+    tile_store = TileStore(store_dir)
+    tile_rasterizer = TileRasterizer(
+        get_parcel_store(json_dir=json_dir), instance_ids=instance_ids
+    )
+    dtype = np.int32 if instance_ids else np.uint8
+    height, width = tile_store.tiles.tile_shape[1:]
+    drawn = 0
+
+    def masks():
+        nonlocal drawn
+        for row in range(len(tile_store)):
+            transform = tile_store.transform(row)
+            extent = (
+                transform.c,
+                transform.c + transform.a * width,
+                transform.f + transform.e * height,
+                transform.f,
+            )
+            mask_data = tile_rasterizer.burn(extent, (width, height))
+            if mask_data is None:
+                yield np.zeros((1, height, width), dtype=dtype)
+            else:
+                drawn += 1
+                yield mask_data[np.newaxis]
+
+    add_array(store_dir, "masks", masks(), (1, height, width), dtype=dtype)
+    print(f"Drew {drawn} masks, {len(tile_store) - drawn} tiles have no parcels")
+
+
+def draw_polygons_from_scene(
+    tiles_dir: str,
+    masks_dir: str,
+    miscs_dir: str,
+    json_dir: str,
+    reference_path: str,
+    instance_ids: bool = False,
+) -> None:
+    # Rasterizes every parcel once onto a mask aligned with the reference
+    # raster the tiles were cut from, then slices each tile's window out of it.
+    # Parcels crossing tile edges end up in both tiles instead of being dropped.
+    store = get_parcel_store(json_dir=json_dir)
+    exterior_starts, exterior_ends = store.exterior_ranges()
+    with rasterio.open(reference_path) as ref:
+        ref_extent = plotting_extent(ref)
+        ref_transform = ref.transform
+        scene_mask = burn_polygons(
+            np.asarray(store.coords),
+            exterior_starts,
+            exterior_ends,
+            ref_extent,
+            (ref.width, ref.height),
+            values=np.arange(1, len(store) + 1) if instance_ids else None,
+        )
 
-                mask_image = Image.new("L", original_resolution, 0)
-                draw = ImageDraw.Draw(mask_image)
-                draw.polygon(polygon_coords_transformed, outline=1, fill=1)
-                mask_array = np.array(mask_image)
+    for image_file in sorted(
+        [file for file in os.listdir(tiles_dir) if file.endswith(".tif")],
+        key=extract_number,
+    ):
+        image_path = os.path.join(tiles_dir, image_file)
+        with rasterio.open(image_path) as src:
+            width, height = src.width, src.height
+            transform = src.transform
+            crs = src.crs
 
-                mask_data = np.maximum(mask_data, mask_array)
-                polygons_drawn = True
+        col, row = ~ref_transform * (transform.c, transform.f)
+        col, row = int(round(col)), int(round(row))
+        mask_data = scene_mask[row : row + height, col : col + width]
 
-        if polygons_drawn:
+        mask_image_path = os.path.join(masks_dir, image_file)
+        misc_image_path = os.path.join(miscs_dir, image_file)
+        if mask_data.shape == (height, width) and mask_data.any():
             with rasterio.open(
                 mask_image_path,
                 "w",
                 driver="GTiff",
-                height=original_resolution[1],
-                width=original_resolution[0],
+                height=height,
+                width=width,
                 count=1,
-                dtype="uint8",
+                dtype=mask_data.dtype,
                 crs=crs,
                 transform=transform,
             ) as dst:
                 dst.write(mask_data, 1)
+            remove_file(misc_image_path)
         else:
             shutil.copy2(image_path, misc_image_path)
+            remove_file(mask_image_path)
+
+    # The index hashes describe masks drawn tile by tile, which differ from
+    # these at tile edges, so the next incremental run redraws every tile.
+    remove_file(os.path.join(masks_dir, "mask_index.json"))
 
 
 if __name__ == "__main__":
@@ -119,6 +405,31 @@ if __name__ == "__main__":
         required=True,
         help="Name of your SAFE folder with saved tiles and responses.",
     )
+    parser.add_argument(
+        "-i",
+        "--instance_ids",
+        action="store_true",
+        help="Fill every parcel with its own ID instead of 1.",
+    )
+    parser.add_argument(
+        "-w",
+        "--whole_scene",
+        action="store_true",
+        help="Rasterize the whole scene once and cut the tile masks out of it.",
+    )
+    parser.add_argument(
+        "-p",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes drawing tile masks in parallel.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tile_store",
+        action="store_true",
+        help="Read the tiles from ./data/tiles/<safe>.tiles and add the masks to it.",
+    )
     args = parser.parse_args()
 
     tiles_dir = os.path.join("./data/tiles", args.safe_name)
@@ -129,9 +440,27 @@ if __name__ == "__main__":
     os.makedirs(masks_dir, exist_ok=True)
     os.makedirs(miscs_dir, exist_ok=True)
 
-    draw_polygons(
-        tiles_dir=tiles_dir,
-        masks_dir=masks_dir,
-        miscs_dir=miscs_dir,
-        json_dir=responses_dir,
-    )
+    if args.tile_store:
+        draw_polygons_to_store(
+            store_dir=tiles_dir + ".tiles",
+            json_dir=responses_dir,
+            instance_ids=args.instance_ids,
+        )
+    elif args.whole_scene:
+        draw_polygons_from_scene(
+            tiles_dir=tiles_dir,
+            masks_dir=masks_dir,
+            miscs_dir=miscs_dir,
+            json_dir=responses_dir,
+            reference_path=os.path.join("./data/refs", args.safe_name + ".tif"),
+            instance_ids=args.instance_ids,
+        )
+    else:
+        draw_polygons(
+            tiles_dir=tiles_dir,
+            masks_dir=masks_dir,
+            miscs_dir=miscs_dir,
+            json_dir=responses_dir,
+            instance_ids=args.instance_ids,
+            workers=args.workers,
+        )
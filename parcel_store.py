@@ -0,0 +1,311 @@
+import os
+import json
+import glob
+import shutil
+import argparse
+import numpy as np
+from geometry import snap_ring, simplify_rings
+
+ATTRIBUTES = (
+    "id",
+    "pnu",
+    "jibun",
+    "bchk",
+    "std_sggcd",
+    "bubun",
+    "bonbun",
+    "addr",
+    "gosi_year",
+    "gosi_month",
+    "jiga",
+)
+
+# Geometry is kept as one flat (V, 2) float64 coordinate array plus three
+# offset arrays: ring_offsets index into coords, polygon_offsets into rings
+# and parcel_offsets into polygons, so parcel i is MultiPolygon
+# polygons[parcel_offsets[i]:parcel_offsets[i + 1]].
+OFFSETS = ("ring_offsets", "polygon_offsets", "parcel_offsets")
+
+
+class ParcelColumns:
+    # With grid and tolerance set, rings are snapped to multiples of grid and
+    # simplified to tolerance (both in degrees) as they are appended.
+    # vertex_counts keeps the number of vertices each parcel arrived with.
+    def __init__(self, grid=None, tolerance=None):
+        self.grid = grid
+        self.tolerance = tolerance
+        self.vertex_counts = []
+        self.coords = []
+        self.ring_sizes = []
+        self.polygon_sizes = []
+        self.parcel_sizes = []
+        self.attributes = {name: [] for name in ATTRIBUTES}
+
+    def __len__(self):
+        return len(self.parcel_sizes)
+
+    def append(self, feature):
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"]
+        if geometry["type"] == "Polygon":
+            polygons = [polygons]
+        vertex_count = 0
+        for polygon in polygons:
+            rings = [np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+            vertex_count += sum(len(ring) for ring in rings)
+            if self.grid:
+                rings = [snap_ring(ring, self.grid) for ring in rings]
+            if self.tolerance:
+                rings = simplify_rings(rings, self.tolerance)
+            self.coords.extend(rings)
+            self.ring_sizes.extend(len(ring) for ring in rings)
+            self.polygon_sizes.append(len(polygon))
+        self.parcel_sizes.append(len(polygons))
+        self.vertex_counts.append(vertex_count)
+
+        properties = {**feature["properties"], "id": feature.get("id")}
+        for name in ATTRIBUTES:
+            value = properties.get(name)
+            self.attributes[name].append("" if value is None else str(value))
+
+    def to_arrays(self):
+        arrays = {
+            "coords": (
+                np.concatenate(self.coords)
+                if self.coords
+                else np.empty((0, 2), dtype=np.float64)
+            ),
+            "ring_offsets": offsets_from_sizes(self.ring_sizes),
+            "polygon_offsets": offsets_from_sizes(self.polygon_sizes),
+            "parcel_offsets": offsets_from_sizes(self.parcel_sizes),
+            "vertex_counts": np.array(self.vertex_counts, dtype=np.int64),
+        }
+        for name, values in self.attributes.items():
+            arrays[name] = np.array(values, dtype=str)
+        arrays["bboxes"] = compute_bboxes(arrays)
+        return arrays
+
+
+def offsets_from_sizes(sizes):
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def expand_ranges(starts, ends):
+    lengths = ends - starts
+    if not len(lengths):
+        return np.empty(0, dtype=np.int64)
+    shifts = starts - np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return np.repeat(shifts, lengths) + np.arange(lengths.sum())
+
+
+def vertex_starts(arrays):
+    ring_offsets = arrays["ring_offsets"]
+    polygon_offsets = arrays["polygon_offsets"]
+    parcel_offsets = arrays["parcel_offsets"]
+    return ring_offsets[polygon_offsets[parcel_offsets]]
+
+
+def compute_bboxes(arrays):
+    coords = arrays["coords"]
+    starts = vertex_starts(arrays)[:-1]
+    if not len(starts):
+        return np.empty((0, 4), dtype=np.float64)
+    return np.column_stack(
+        [
+            np.minimum.reduceat(coords[:, 0], starts),
+            np.minimum.reduceat(coords[:, 1], starts),
+            np.maximum.reduceat(coords[:, 0], starts),
+            np.maximum.reduceat(coords[:, 1], starts),
+        ]
+    )
+
+
+def take(arrays, indices):
+    indices = np.asarray(indices, dtype=np.int64)
+    parcel_offsets = arrays["parcel_offsets"]
+    polygon_offsets = arrays["polygon_offsets"]
+    ring_offsets = arrays["ring_offsets"]
+
+    polygons = expand_ranges(parcel_offsets[indices], parcel_offsets[indices + 1])
+    rings = expand_ranges(polygon_offsets[polygons], polygon_offsets[polygons + 1])
+    vertices = expand_ranges(ring_offsets[rings], ring_offsets[rings + 1])
+
+    selected = {
+        "coords": arrays["coords"][vertices],
+        "ring_offsets": offsets_from_sizes(
+            ring_offsets[rings + 1] - ring_offsets[rings]
+        ),
+        "polygon_offsets": offsets_from_sizes(
+            polygon_offsets[polygons + 1] - polygon_offsets[polygons]
+        ),
+        "parcel_offsets": offsets_from_sizes(
+            parcel_offsets[indices + 1] - parcel_offsets[indices]
+        ),
+    }
+    for name, array in arrays.items():
+        if name not in selected:
+            selected[name] = array[indices]
+    return selected
+
+
+def concatenate(parts):
+    parts = [part for part in parts if len(part["parcel_offsets"]) > 1]
+    if not parts:
+        return ParcelColumns().to_arrays()
+
+    merged = {}
+    for name in OFFSETS:
+        chunks = [np.zeros(1, dtype=np.int64)]
+        shift = 0
+        for part in parts:
+            chunks.append(part[name][1:] + shift)
+            shift += part[name][-1]
+        merged[name] = np.concatenate(chunks)
+    for name in parts[0]:
+        if name not in merged:
+            merged[name] = np.concatenate([part[name] for part in parts])
+    return merged
+
+
+def parcel_keys(arrays):
+    return np.where(arrays["id"] != "", arrays["id"], arrays["pnu"])
+
+
+def deduplicate(arrays):
+    _, first = np.unique(parcel_keys(arrays), return_index=True)
+    if len(first) == len(arrays["parcel_offsets"]) - 1:
+        return arrays
+    return take(arrays, np.sort(first))
+
+
+def save_page(file_path, arrays):
+    with open(file_path, "wb") as page_file:
+        np.savez_compressed(page_file, **arrays)
+
+
+def load_page(file_path):
+    with np.load(file_path) as page:
+        arrays = {name: page[name] for name in page.files}
+    if "vertex_counts" not in arrays:
+        arrays["vertex_counts"] = np.diff(vertex_starts(arrays))
+    return arrays
+
+
+def save_store(store_dir, arrays):
+    tmp_dir = store_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.rename(tmp_dir, store_dir)
+
+
+def build_store(json_dir, store_dir=None, file_numbers=None):
+    # file_numbers limits the store to those pages, e.g. the ones done in the
+    # current crawl plan; by default every page in json_dir is merged.
+    store_dir = store_dir or os.path.join(json_dir, "parcels")
+    if file_numbers is None:
+        page_paths = glob.glob(os.path.join(json_dir, "response_*.npz"))
+    else:
+        page_paths = [
+            os.path.join(json_dir, f"response_{file_number}.npz")
+            for file_number in file_numbers
+        ]
+    arrays = deduplicate(concatenate([load_page(path) for path in page_paths]))
+    save_store(store_dir, arrays)
+    print(
+        f"Saved {len(arrays['parcel_offsets']) - 1} parcels from "
+        f"{len(page_paths)} pages to {store_dir}"
+    )
+    return store_dir
+
+
+def import_json_dir(json_dir, store_dir=None):
+    store_dir = store_dir or os.path.join(json_dir, "parcels")
+    columns = ParcelColumns()
+    json_files = [file for file in os.listdir(json_dir) if file.endswith(".json")]
+    for json_file in json_files:
+        with open(os.path.join(json_dir, json_file)) as f:
+            for feature in json.load(f)["features"]:
+                columns.append(feature)
+    arrays = deduplicate(columns.to_arrays())
+    save_store(store_dir, arrays)
+    print(
+        f"Imported {len(arrays['parcel_offsets']) - 1} parcels from "
+        f"{len(json_files)} JSON files to {store_dir}"
+    )
+    return store_dir
+
+
+class ParcelStore:
+    def __init__(self, store_dir):
+        self.arrays = {
+            os.path.splitext(name)[0]: np.load(
+                os.path.join(store_dir, name), mmap_mode="r"
+            )
+            for name in os.listdir(store_dir)
+            if name.endswith(".npy")
+        }
+        self.coords = self.arrays["coords"]
+        self.ring_offsets = self.arrays["ring_offsets"]
+        self.polygon_offsets = self.arrays["polygon_offsets"]
+        self.parcel_offsets = self.arrays["parcel_offsets"]
+        self.bboxes = self.arrays["bboxes"]
+
+    def __len__(self):
+        return len(self.parcel_offsets) - 1
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def exterior_ranges(self):
+        rings = self.polygon_offsets[self.parcel_offsets[:-1]]
+        return self.ring_offsets[rings], self.ring_offsets[rings + 1]
+
+    def exterior(self, index):
+        ring = self.polygon_offsets[self.parcel_offsets[index]]
+        return self.coords[self.ring_offsets[ring] : self.ring_offsets[ring + 1]]
+
+    def exteriors(self):
+        starts, ends = self.exterior_ranges()
+        return [self.coords[start:end] for start, end in zip(starts, ends)]
+
+    def exterior_bboxes(self):
+        if not len(self):
+            return np.empty((0, 4), dtype=np.float64)
+        starts, ends = self.exterior_ranges()
+        bounds = np.column_stack([starts, ends]).ravel()
+        x = np.append(self.coords[:, 0], 0.0)
+        y = np.append(self.coords[:, 1], 0.0)
+        return np.column_stack(
+            [
+                np.minimum.reduceat(x, bounds)[::2],
+                np.minimum.reduceat(y, bounds)[::2],
+                np.maximum.reduceat(x, bounds)[::2],
+                np.maximum.reduceat(y, bounds)[::2],
+            ]
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-j",
+        "--json_dir",
+        type=str,
+        required=True,
+        help="Path to Directory with response_*.json Files",
+    )
+    parser.add_argument(
+        "-o",
+        "--store_dir",
+        type=str,
+        default=None,
+        help="Path to the Parcel Store, defaults to <json_dir>/parcels",
+    )
+    args = parser.parse_args()
+
+    import_json_dir(json_dir=args.json_dir, store_dir=args.store_dir)
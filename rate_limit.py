@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import asyncio
+import datetime
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+class RateLimiter:
+    # Token bucket shared by every request of a crawl. The rate is halved when
+    # V-World starts throttling and creeps back up to the configured rate on
+    # successful requests. Requests are also counted against a daily budget
+    # that is persisted in state_path, so separate runs on the same key add up.
+    def __init__(self, rate=10.0, daily_budget=None, state_path=None, min_rate=0.2):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+        self.daily_budget = daily_budget
+        self.state_path = state_path
+        self.exhausted = False
+        self.day = datetime.date.today().isoformat()
+        self.used = 0
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if state.get("day") == self.day:
+                self.used = state.get("used", 0)
+
+    def check_budget(self):
+        today = datetime.date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.used = 0
+            self.exhausted = False
+        if self.exhausted or (
+            self.daily_budget is not None and self.used >= self.daily_budget
+        ):
+            self.exhausted = True
+            raise QuotaExceededError(
+                f"Daily request budget is used up ({self.used} requests on {self.day})"
+            )
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                self.check_budget()
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.tokens -= 1
+            self.used += 1
+            if self.used % 20 == 0:
+                self.save()
+
+    def throttle(self, retry_after=None):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.paused_until = time.monotonic() + (retry_after or 5.0)
+        print(f"V-World is throttling requests, slowing down to {self.rate:.2f} req/s")
+
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.02)
+
+    def exhaust(self):
+        self.exhausted = True
+        self.save()
+
+    def status(self, remaining):
+        eta = datetime.timedelta(seconds=round(remaining / self.rate))
+        message = (
+            f"{self.used} requests used today, {remaining} pages to go, "
+            f"ETA {eta} at {self.rate:.2f} req/s"
+        )
+        if self.daily_budget is not None:
+            left = max(0, self.daily_budget - self.used)
+            message += f", {left} requests left in today's budget"
+            if remaining > left:
+                message += " (the rest needs a --resume run after the reset)"
+        return message
+
+    def save(self):
+        if not self.state_path:
+            return
+        with open(self.state_path, "w") as state_file:
+            json.dump({"day": self.day, "used": self.used}, state_file)
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import contextlib
+
+
+class CacheEntry:
+    def __init__(self, cache, key, hit):
+        self.cache = cache
+        self.key = key
+        self.hit = hit
+        self.path = cache.path(key)
+        self.part_file = None
+        if not hit:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.part_file = open(self.path + ".part", "wb")
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def write(self, chunk):
+        if self.part_file is not None:
+            self.part_file.write(self.compressor.compress(chunk))
+
+    def commit(self, release=""):
+        if self.part_file is None:
+            return
+        self.part_file.write(self.compressor.flush())
+        self.part_file.close()
+        self.part_file = None
+        os.replace(self.path + ".part", self.path)
+        self.cache.store(self.key, os.path.getsize(self.path), release)
+
+    def abort(self):
+        if self.part_file is not None:
+            self.part_file.close()
+            self.part_file = None
+            os.remove(self.path + ".part")
+
+    def read(self):
+        with open(self.path, "rb") as cached_file:
+            return zlib.decompress(cached_file.read(), 31)
+
+    @contextlib.asynccontextmanager
+    async def replay(self, chunk_size=65536):
+        async def chunks():
+            decompressor = zlib.decompressobj(31)
+            with open(self.path, "rb") as cached_file:
+                while block := cached_file.read(chunk_size):
+                    yield decompressor.decompress(block)
+            yield decompressor.flush()
+
+        yield chunks()
+
+
+class ResponseCache:
+    # Gzipped WFS response bodies addressed by a hash of the normalized query
+    # (the auth key is not part of it). Every entry is tagged with the data
+    # release it was fetched in, the newest gosi_year seen so far. Entries
+    # expire after ttl_days or once a newer release has been seen, and the
+    # least recently used ones are evicted beyond max_bytes.
+    KEY_FIELDS = (
+        "TYPENAME",
+        "BBOX",
+        "STARTINDEX",
+        "PROPERTYNAME",
+        "COUNT",
+        "SRSNAME",
+        "VERSION",
+    )
+
+    def __init__(self, cache_dir, max_bytes=4 * 1024**3, ttl_days=180, release=""):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.connection = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                release TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """)
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'release'"
+        ).fetchone()
+        self.release = max(release, row[0] if row else "")
+
+    def make_key(self, payload):
+        normalized = {field: str(payload.get(field, "")) for field in self.KEY_FIELDS}
+        return hashlib.sha256(
+            json.dumps(normalized, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".gz")
+
+    def lookup(self, payload):
+        key = self.make_key(payload)
+        row = self.connection.execute(
+            "SELECT created, release FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row:
+            created, release = row
+            fresh = time.time() - created < self.ttl and release >= self.release
+            if fresh and os.path.exists(self.path(key)):
+                self.connection.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key)
+                )
+                self.hits += 1
+                return CacheEntry(self, key, hit=True)
+            self.stale += 1
+            self.remove(key)
+        self.misses += 1
+        return CacheEntry(self, key, hit=False)
+
+    def store(self, key, size, release=""):
+        # release is the newest gosi_year in the response, empty for probes.
+        # A newer one than any seen before makes every older entry stale.
+        if release > self.release:
+            if self.release:
+                print(f"V-World data release changed from {self.release} to {release}")
+            self.release = release
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('release', ?)",
+                (release,),
+            )
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries (key, size, release, created, accessed) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, size, self.release, now, now),
+        )
+        self.evict()
+
+    def remove(self, key):
+        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(key))
+
+    def total_bytes(self):
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    def evict(self):
+        total = self.total_bytes()
+        while total > self.max_bytes:
+            rows = self.connection.execute(
+                "SELECT key, size FROM entries ORDER BY accessed LIMIT 64"
+            ).fetchall()
+            for key, size in rows:
+                self.remove(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def report(self):
+        requests = self.hits + self.misses
+        ratio = self.hits / requests if requests else 0.0
+        entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        print(
+            f"Response cache: {self.hits} hits, {self.misses} misses "
+            f"({self.stale} stale), hit ratio {ratio:.1%}, "
+            f"{entries} entries using {self.total_bytes() / 1024**2:.1f} MiB"
+        )
+
+    def close(self):
+        self.connection.close()
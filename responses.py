@@ -1,7 +1,10 @@
 import os
 import json
 import argparse
+import numpy as np
 from to_get_rice import get_rice_info
+from parcel_store import ParcelStore, save_store, take
+from geometry import bbox_ring
 
 
 def load_json(filepath):
@@ -16,64 +19,107 @@ def load_json(filepath):
         return None
 
 
-def get_last_json_file_number(directory):
-    try:
-        files = os.listdir(directory)
-        json_files = [file for file in files if file.endswith(".json")]
-        if not json_files:
-            return -1
-        numbers = [int(file.split("_")[1].split(".")[0]) for file in json_files]
-        return max(numbers)
-    except Exception as e:
-        print(f"Error: Failed to process files in directory {directory} - {e}")
-        return -1
-
-
-def get_responses_from_safe(responses_dir, json_path, AUTH_KEY):
+def get_responses_from_safe(
+    responses_dir, json_path, AUTH_KEY, resume=False, cache_dir=None, **options
+):
     metadata = load_json(json_path)
     if metadata and "bbox" in metadata:
         y_min = metadata["bbox"]["y_min"]
         x_min = metadata["bbox"]["x_min"]
         y_max = metadata["bbox"]["y_max"]
         x_max = metadata["bbox"]["x_max"]
+        footprint = metadata.get("footprint")
 
-        last_json_file_number = get_last_json_file_number(responses_dir)
-        print(last_json_file_number)
-        if last_json_file_number == -1:
-            get_rice_info(
-                AUTH_KEY,
-                y_min=y_min,
-                x_min=x_min,
-                y_max=y_max,
-                x_max=x_max,
-                json_dir=responses_dir,
-                start_index=0,
-            )
-        else:
-            get_rice_info(
-                AUTH_KEY,
-                y_min=y_min,
-                x_min=x_min,
-                y_max=y_max,
-                x_max=x_max,
-                json_dir=responses_dir,
-                start_index=last_json_file_number * 1000,
-            )
+        get_rice_info(
+            AUTH_KEY,
+            y_min=y_min,
+            x_min=x_min,
+            y_max=y_max,
+            x_max=x_max,
+            json_dir=responses_dir,
+            resume=resume,
+            cache_dir=cache_dir,
+            regions=[footprint] if footprint else None,
+            **options,
+        )
     else:
         print(
             "Error: Metadata is missing or does not contain bounding box information."
         )
 
 
+def shard_parcels(shared_dir, responses_root, scenes):
+    store = ParcelStore(os.path.join(shared_dir, "parcels"))
+    bboxes = store.bboxes
+    for safe_name, (y_min, x_min, y_max, x_max) in scenes.items():
+        inside = np.flatnonzero(
+            (bboxes[:, 0] <= x_max)
+            & (bboxes[:, 2] >= x_min)
+            & (bboxes[:, 1] <= y_max)
+            & (bboxes[:, 3] >= y_min)
+        )
+        responses_dir = os.path.join(responses_root, safe_name)
+        os.makedirs(responses_dir, exist_ok=True)
+        save_store(os.path.join(responses_dir, "parcels"), take(store.arrays, inside))
+        print(f"Saved {len(inside)} of {len(store)} parcels for {safe_name}")
+
+
+def get_responses_for_all_safes(
+    refs_dir, responses_root, AUTH_KEY, resume=False, cache_dir=None, **options
+):
+    scenes = {}
+    footprints = []
+    for json_file in sorted(os.listdir(refs_dir)):
+        if not json_file.endswith(".json"):
+            continue
+        metadata = load_json(os.path.join(refs_dir, json_file))
+        if not metadata or "bbox" not in metadata:
+            print(f"Error: {json_file} does not contain bounding box information.")
+            continue
+        bbox = metadata["bbox"]
+        scene_bbox = tuple(
+            float(bbox[key]) for key in ("y_min", "x_min", "y_max", "x_max")
+        )
+        scenes[os.path.splitext(json_file)[0]] = scene_bbox
+        footprints.append(metadata.get("footprint") or bbox_ring(scene_bbox))
+
+    if not scenes:
+        print(f"Error: No bounding boxes found in {refs_dir}.")
+        return
+
+    regions = list(scenes.values())
+    shared_dir = os.path.join(responses_root, "_shared")
+    os.makedirs(shared_dir, exist_ok=True)
+    get_rice_info(
+        AUTH_KEY,
+        y_min=min(region[0] for region in regions),
+        x_min=min(region[1] for region in regions),
+        y_max=max(region[2] for region in regions),
+        x_max=max(region[3] for region in regions),
+        json_dir=shared_dir,
+        resume=resume,
+        cache_dir=cache_dir,
+        regions=footprints,
+        **options,
+    )
+    shard_parcels(shared_dir, responses_root, scenes)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-s",
         "--safe_name",
         type=str,
-        required=True,
+        default=None,
         help="Name of your SAFE folder with saved tiles and responses.",
     )
+    parser.add_argument(
+        "-a",
+        "--all_safes",
+        action="store_true",
+        help="Fetch the union of all SAFE bounding boxes in ./data/refs once.",
+    )
     parser.add_argument(
         "-k",
         "--auth_key",
@@ -81,12 +127,74 @@ if __name__ == "__main__":
         required=True,
         help="Issued V-World Authentication Key",
     )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted crawl from its manifest.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache_dir",
+        type=str,
+        default="./data/cache",
+        help="Directory to cache V-World responses across runs and scenes.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Maximum number of requests per second to V-World.",
+    )
+    parser.add_argument(
+        "--daily_budget",
+        type=int,
+        default=None,
+        help="Maximum number of requests per day for the authentication key.",
+    )
+    parser.add_argument(
+        "--snap_grid",
+        type=float,
+        default=None,
+        help="Snap parcel coordinates to multiples of this many degrees, e.g. 1e-6.",
+    )
+    parser.add_argument(
+        "--simplify",
+        type=float,
+        default=None,
+        help="Simplify parcel rings to this fraction of a 10 m pixel, e.g. 0.25.",
+    )
     args = parser.parse_args()
+    options = {
+        "rate": args.rate,
+        "daily_budget": args.daily_budget,
+        "quota_file": "./data/quota.json",
+        "snap_grid": args.snap_grid,
+        "simplify": args.simplify,
+    }
+
+    if args.all_safes:
+        get_responses_for_all_safes(
+            refs_dir="./data/refs",
+            responses_root="./data/responses",
+            AUTH_KEY=args.auth_key,
+            resume=args.resume,
+            cache_dir=args.cache_dir,
+            **options,
+        )
+        raise SystemExit
+    if not args.safe_name:
+        parser.error("either --safe_name or --all_safes is required")
 
     responses_dir = os.path.join("./data/responses", args.safe_name)
     json_path = os.path.join("./data/refs", args.safe_name + ".json")
     os.makedirs(responses_dir, exist_ok=True)
 
     get_responses_from_safe(
-        responses_dir=responses_dir, json_path=json_path, AUTH_KEY=args.auth_key
+        responses_dir=responses_dir,
+        json_path=json_path,
+        AUTH_KEY=args.auth_key,
+        resume=args.resume,
+        cache_dir=args.cache_dir,
+        **options,
     )
@@ -0,0 +1,147 @@
+import time
+import sqlite3
+
+FINAL_STATES = ("kept", "unclear", "later")
+
+
+class ReviewQueue:
+    # One row per mask to review. An item is "pending" until a reviewer claims
+    # it, then "claimed" with a lease; a claim whose lease ran out goes to the
+    # next reviewer. The decision moves it to "kept", "unclear" or "later".
+    # Items that could not be sent max_attempts times are parked as "failed".
+    # Every change is a single SQLite transaction, so a restarted bot carries
+    # on where it stopped and open claims simply expire.
+    def __init__(self, path, lease_seconds=1800):
+        self.lease_seconds = lease_seconds
+        self.connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY,
+                filename TEXT NOT NULL UNIQUE,
+                state TEXT NOT NULL DEFAULT 'pending',
+                reviewer INTEGER,
+                lease_until REAL,
+                updated REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                file_id TEXT,
+                preview TEXT
+            );
+            CREATE INDEX IF NOT EXISTS items_state ON items (state, id);
+            CREATE INDEX IF NOT EXISTS items_lease ON items (state, lease_until);
+            CREATE INDEX IF NOT EXISTS items_reviewer ON items (reviewer, state);
+            """)
+
+    def sync(self, filenames):
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO items (filename, updated) VALUES (?, ?)",
+                [(filename, time.time()) for filename in sorted(filenames)],
+            )
+
+    def claim_next(self, reviewer, states=("pending",)):
+        # Hands out the reviewer's own open claim first, then an expired claim
+        # of someone else, then the oldest item in one of states.
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = (
+                self.connection.execute(
+                    "SELECT id FROM items WHERE reviewer = ? AND state = 'claimed' "
+                    "LIMIT 1",
+                    (reviewer,),
+                ).fetchone()
+                or self.connection.execute(
+                    "SELECT id FROM items WHERE state = 'claimed' AND lease_until < ? "
+                    "ORDER BY lease_until LIMIT 1",
+                    (now,),
+                ).fetchone()
+                or self.connection.execute(
+                    f"SELECT id FROM items WHERE state IN "
+                    f"({','.join('?' * len(states))}) ORDER BY id LIMIT 1",
+                    states,
+                ).fetchone()
+            )
+            if row is None:
+                return None
+            return self.connection.execute(
+                "UPDATE items SET state = 'claimed', reviewer = ?, lease_until = ?, "
+                "updated = ? WHERE id = ? RETURNING filename",
+                (reviewer, now + self.lease_seconds, now, row[0]),
+            ).fetchone()[0]
+
+    def upcoming(self, limit):
+        return [
+            filename
+            for (filename,) in self.connection.execute(
+                "SELECT filename FROM items WHERE state = 'pending' "
+                "ORDER BY id LIMIT ?",
+                (limit,),
+            )
+        ]
+
+    def finish(self, filename, reviewer, state):
+        # Returns False when the item is not (or no longer) claimed by reviewer.
+        if state not in FINAL_STATES:
+            raise ValueError(f"Unknown review state {state}")
+        # Deferred items go to the back, so re-reviewing "later" cycles
+        # through all of them instead of handing out the same one again.
+        cursor = self.connection.execute(
+            "UPDATE items SET state = ?, reviewer = NULL, lease_until = NULL, "
+            "updated = ?, id = CASE WHEN ? = 'later' "
+            "THEN (SELECT MAX(id) + 1 FROM items) ELSE id END "
+            "WHERE filename = ? AND state = 'claimed' AND reviewer = ?",
+            (state, time.time(), state, filename, reviewer),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, filename, reviewer, error, state="pending", max_attempts=3):
+        # The item goes to the back of state, so one broken item does not
+        # block the queue, and is parked as "failed" after max_attempts.
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "UPDATE items SET id = (SELECT MAX(id) + 1 FROM items), "
+                "attempts = attempts + 1, error = ?, "
+                "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE ? END, "
+                "reviewer = NULL, lease_until = NULL, updated = ? "
+                "WHERE filename = ? AND state = 'claimed' AND reviewer = ?",
+                (str(error), max_attempts, state, time.time(), filename, reviewer),
+            )
+
+    def file_id(self, filename, preview):
+        # Telegram file_id of the preview sent earlier, if it was the same kind.
+        row = self.connection.execute(
+            "SELECT file_id FROM items WHERE filename = ? AND preview = ?",
+            (filename, preview),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_file_id(self, filename, preview, file_id):
+        self.connection.execute(
+            "UPDATE items SET file_id = ?, preview = ? WHERE filename = ?",
+            (file_id, preview, filename),
+        )
+
+    def remove(self, filename):
+        self.connection.execute("DELETE FROM items WHERE filename = ?", (filename,))
+
+    def items(self, state):
+        return [
+            filename
+            for (filename,) in self.connection.execute(
+                "SELECT filename FROM items WHERE state = ? ORDER BY id", (state,)
+            )
+        ]
+
+    def summary(self):
+        return dict(
+            self.connection.execute(
+                "SELECT state, COUNT(*) FROM items GROUP BY state"
+            ).fetchall()
+        )
+
+    def close(self):
+        self.connection.close()
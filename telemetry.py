@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import aiohttp
+
+LATENCY_BUCKETS = (
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+PHASES = ("connect", "first_byte", "total")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = next(
+            (i for i, bound in enumerate(self.buckets) if value <= bound),
+            len(self.buckets),
+        )
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class FetchTelemetry:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latency = {phase: Histogram() for phase in PHASES}
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "throttles": 0,
+            "cache_hits": 0,
+            "downloaded_bytes": 0,
+            "features_downloaded": 0,
+            "features_kept": 0,
+        }
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def trace_config(self):
+        # connect is only observed for requests that open a new connection,
+        # first_byte is the time until the response headers have arrived.
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.started = time.monotonic()
+
+        async def on_connection_create_start(session, context, params):
+            context.connecting = time.monotonic()
+
+        async def on_connection_create_end(session, context, params):
+            self.latency["connect"].observe(time.monotonic() - context.connecting)
+
+        async def on_request_end(session, context, params):
+            self.latency["first_byte"].observe(time.monotonic() - context.started)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        downloaded = self.counters["features_downloaded"]
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            **self.counters,
+            "features_per_second": round(downloaded / elapsed, 3) if elapsed else 0,
+            "bytes_per_second": (
+                round(self.counters["downloaded_bytes"] / elapsed, 1) if elapsed else 0
+            ),
+            "kept_ratio": (
+                round(self.counters["features_kept"] / downloaded, 4)
+                if downloaded
+                else None
+            ),
+            "latency_seconds": {
+                phase: {
+                    "count": histogram.count,
+                    "mean": (
+                        round(histogram.sum / histogram.count, 4)
+                        if histogram.count
+                        else None
+                    ),
+                    "p50": histogram.quantile(0.5),
+                    "p90": histogram.quantile(0.9),
+                    "p99": histogram.quantile(0.99),
+                }
+                for phase, histogram in self.latency.items()
+            },
+        }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = [
+            "# HELP vworld_request_duration_seconds V-World request latency by phase.",
+            "# TYPE vworld_request_duration_seconds histogram",
+        ]
+        for phase, histogram in self.latency.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'vworld_request_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'vworld_request_duration_seconds_sum{{phase="{phase}"}} {histogram.sum}'
+            )
+            lines.append(
+                f'vworld_request_duration_seconds_count{{phase="{phase}"}} {histogram.count}'
+            )
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE vworld_{name}_total counter")
+            lines.append(f"vworld_{name}_total {value}")
+        for name in ("elapsed_seconds", "features_per_second", "bytes_per_second"):
+            lines.append(f"# TYPE vworld_{name} gauge")
+            lines.append(f"vworld_{name} {summary[name]}")
+        lines.append("# TYPE vworld_kept_ratio gauge")
+        lines.append(f"vworld_kept_ratio {summary['kept_ratio'] or 0}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path, prometheus_path):
+        with open(json_path, "w") as json_file:
+            json.dump(self.summary(), json_file, indent=4)
+        # node_exporter may scrape at any moment, so swap the file in atomically
+        with open(prometheus_path + ".tmp", "w") as prometheus_file:
+            prometheus_file.write(self.prometheus())
+        os.replace(prometheus_path + ".tmp", prometheus_path)
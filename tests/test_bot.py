@@ -0,0 +1,271 @@
+import os
+import asyncio
+import itertools
+import pytest
+import numpy as np
+from aiohttp import web
+from PIL import Image
+from telegram import Update
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler
+import bot
+from review_queue import ReviewQueue
+
+
+def test_renderer_retries_failed_renders(tmp_path, monkeypatch):
+    (tmp_path / "tifs").mkdir()
+    (tmp_path / "pngs").mkdir()
+    Image.fromarray(np.zeros((8, 8, 3), dtype=np.uint8)).save(tmp_path / "tifs/a.tif")
+    renderer = bot.PngRenderer(str(tmp_path / "pngs"), str(tmp_path / "tifs"))
+
+    open_image = Image.open
+    failures = [OSError("transient")]
+
+    def flaky_open(path, *args):
+        if failures:
+            raise failures.pop()
+        return open_image(path, *args)
+
+    monkeypatch.setattr(bot.Image, "open", flaky_open)
+
+    async def render_twice():
+        try:
+            await renderer.path("a.png")
+        except OSError:
+            pass
+        return await renderer.path("a.png")
+
+    assert asyncio.run(render_twice()) == str(tmp_path / "pngs/a.png")
+    assert not renderer.futures
+
+
+class StandInBotApi:
+    # Answers the Bot API methods the review bot uses and counts the photos
+    # that were uploaded rather than sent by file_id.
+    def __init__(self):
+        self.calls = []
+        self.uploads = 0
+        self.rejected = set()
+        self.message_ids = itertools.count(1)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = {}
+        if request.content_type.startswith("multipart"):
+            async for part in await request.multipart():
+                if part.filename:
+                    self.uploads += 1
+                    data[part.name] = "<upload>"
+                    await part.read()
+                else:
+                    data[part.name] = await part.text()
+        else:
+            data = dict(await request.post())
+        self.calls.append((method, data.get("photo")))
+
+        if method == "getMe":
+            return web.json_response(
+                {
+                    "ok": True,
+                    "result": {
+                        "id": 1,
+                        "is_bot": True,
+                        "first_name": "bot",
+                        "username": "review_bot",
+                    },
+                }
+            )
+        if method == "answerCallbackQuery":
+            return web.json_response({"ok": True, "result": True})
+        message = {
+            "message_id": next(self.message_ids),
+            "date": 0,
+            "chat": {"id": CHAT_ID, "type": "private"},
+        }
+        if method == "sendPhoto":
+            if data["photo"] in self.rejected:
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 400,
+                        "description": "Bad Request: wrong file identifier",
+                    },
+                    status=400,
+                )
+            file_id = data["photo"]
+            if file_id == "<upload>":
+                file_id = f"file-{message['message_id']}"
+            message["photo"] = [
+                {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "width": 256,
+                    "height": 128,
+                }
+            ]
+        return web.json_response({"ok": True, "result": message})
+
+    def photos(self):
+        return [photo for method, photo in self.calls if method == "sendPhoto"]
+
+
+CHAT_ID = 7
+USER = {"id": CHAT_ID, "is_bot": False, "first_name": "reviewer"}
+CHAT = {"id": CHAT_ID, "type": "private"}
+
+
+def command(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "text": text,
+            "chat": CHAT,
+            "from": USER,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }
+
+
+def press(update_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "chat",
+            "data": data,
+            "from": USER,
+            "message": {"message_id": 1, "date": 0, "chat": CHAT},
+        },
+    }
+
+
+@pytest.fixture
+def review_dirs(tmp_path, monkeypatch):
+    dirs = {
+        name: tmp_path / name
+        for name in (
+            "tif_dir",
+            "mask_dir",
+            "image_dir",
+            "clean_dir",
+            "unclear_dir",
+            "later_dir",
+        )
+    }
+    for name, path in dirs.items():
+        path.mkdir()
+        monkeypatch.setattr(bot, name, str(path), raising=False)
+    for name, value in (
+        ("prefetch", 2),
+        ("preview", "side"),
+        ("max_attempts", 3),
+        ("renderer", None),
+        ("queue", None),
+    ):
+        monkeypatch.setattr(bot, name, value, raising=False)
+
+    rng = np.random.default_rng(0)
+    mask = np.zeros((128, 128), dtype=np.uint8)
+    mask[20:60, 30:90] = 1
+    for number in range(4):
+        tile = rng.integers(0, 255, (128, 128, 3), dtype=np.uint8)
+        Image.fromarray(tile).save(dirs["tif_dir"] / f"tile_{number}.tif")
+        Image.fromarray(mask).save(dirs["mask_dir"] / f"tile_{number}.png")
+    bot.renderer = bot.PngRenderer(str(dirs["image_dir"]), str(dirs["tif_dir"]))
+    bot.queue = ReviewQueue(str(tmp_path / "queue.sqlite"))
+    bot.sync_queue()
+    yield dirs
+    bot.queue.close()
+
+
+async def review(api, actions):
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+
+    application = (
+        ApplicationBuilder()
+        .token("TOKEN")
+        .base_url(f"http://127.0.0.1:{port}/bot")
+        .build()
+    )
+    application.add_handler(CommandHandler("start", bot.start))
+    application.add_handler(CommandHandler("later", bot.later))
+    application.add_handler(CallbackQueryHandler(bot.button))
+    await application.initialize()
+    try:
+        for update_id, action in enumerate(actions, 1):
+            if action.startswith("/"):
+                update = command(update_id, action)
+            else:
+                update = press(update_id, action)
+            await application.process_update(Update.de_json(update, application.bot))
+    finally:
+        await application.shutdown()
+        await runner.cleanup()
+
+
+def test_one_upload_per_item_and_later_items_by_file_id(review_dirs):
+    api = StandInBotApi()
+    asyncio.run(
+        review(
+            api,
+            [
+                "/start",
+                "later:tile_0.png",
+                "later:tile_1.png",
+                "later:tile_2.png",
+                "move:tile_3.png",
+            ],
+        )
+    )
+    # One photo with the keyboard per item, no media groups or extra messages
+    assert api.uploads == 4
+    assert [method for method, _ in api.calls].count("sendPhoto") == 4
+    assert "sendMediaGroup" not in [method for method, _ in api.calls]
+
+    file_ids = [bot.queue.file_id(f"tile_{number}.png", "side") for number in range(3)]
+    api.calls.clear()
+    api.uploads = 0
+    asyncio.run(
+        review(
+            api,
+            ["/later", "later:tile_0.png", "later:tile_1.png", "keep:tile_2.png"]
+            + ["later:tile_0.png"],
+        )
+    )
+    # Deferring again moves on to the next later item
+    assert api.uploads == 0
+    assert api.photos() == file_ids + file_ids[:2]
+    assert os.listdir(review_dirs["clean_dir"]) == ["tile_2.png"]
+    assert sorted(os.listdir(review_dirs["later_dir"])) == ["tile_0.png", "tile_1.png"]
+    assert os.listdir(review_dirs["unclear_dir"]) == ["tile_3.png"]
+
+
+def test_rejected_file_id_is_uploaded_again(review_dirs):
+    api = StandInBotApi()
+    asyncio.run(
+        review(
+            api,
+            [
+                "/start",
+                "later:tile_0.png",
+                "keep:tile_1.png",
+                "keep:tile_2.png",
+                "keep:tile_3.png",
+            ],
+        )
+    )
+    file_id = bot.queue.file_id("tile_0.png", "side")
+    api.rejected.add(file_id)
+    api.calls.clear()
+    api.uploads = 0
+
+    asyncio.run(review(api, ["/later"]))
+    assert api.photos() == [file_id, "<upload>"]
+    assert api.uploads == 1
+    assert bot.queue.file_id("tile_0.png", "side") not in (None, file_id)
@@ -0,0 +1,198 @@
+import asyncio
+import pytest
+from aiohttp import web
+import to_get_rice
+from parcel_store import ParcelStore
+
+# Stand-in for the V-World WFS: a 20 x 20 grid of small parcels, of which the
+# ones in column 9 and row 9 straddle the first quadtree split, plus a cluster
+# of 1200 parcels small enough to stay in one cell down to the maximum depth,
+# so that cell has to be paged with STARTINDEX.
+BBOX = (34.0, 126.0, 34.2, 126.2)
+
+
+def make_parcels():
+    parcels = []
+    for i in range(20):
+        for j in range(20):
+            x = 126.005 + i * 0.01
+            y = 34.005 + j * 0.01
+            parcels.append((f"grid.{i}.{j}", (x, y, x + 0.008, y + 0.008)))
+    for k in range(1200):
+        x = 126.05005 + (k % 40) * 1e-6
+        y = 34.05005 + (k // 40) * 1e-6
+        parcels.append((f"cluster.{k}", (x, y, x + 5e-7, y + 5e-7)))
+    return parcels
+
+
+def feature(index, key, bounds):
+    x_min, y_min, x_max, y_max = bounds
+    ring = [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max]]
+    return {
+        "type": "Feature",
+        "id": key,
+        "geometry": {"type": "MultiPolygon", "coordinates": [[ring + ring[:1]]]},
+        "properties": {
+            "pnu": str(index),
+            "jibun": "12답" if index % 3 else "12전",
+            "gosi_year": "2023",
+            "gosi_month": "01",
+        },
+    }
+
+
+class StandInWfs:
+    def __init__(self):
+        self.parcels = make_parcels()
+        self.requests = []
+        self.fail_once = set()
+        self.throttle_once = set()
+        self.broken = set()
+
+    def select(self, bbox):
+        y_min, x_min, y_max, x_max = (float(value) for value in bbox.split(","))
+        return [
+            (index, key, bounds)
+            for index, (key, bounds) in enumerate(self.parcels)
+            if bounds[0] < x_max
+            and bounds[2] > x_min
+            and bounds[1] < y_max
+            and bounds[3] > y_min
+        ]
+
+    async def handle(self, request):
+        query = request.query
+        page = (query["BBOX"], query.get("STARTINDEX"))
+        self.requests.append(page)
+        if page in self.broken:
+            return web.Response(status=400, text="<error>bad page</error>")
+        if page in self.fail_once:
+            self.fail_once.discard(page)
+            return web.Response(status=503, text="busy")
+        if page in self.throttle_once:
+            self.throttle_once.discard(page)
+            return web.Response(status=429, headers={"Retry-After": "0.05"})
+
+        selected = self.select(query["BBOX"])
+        start = int(query.get("STARTINDEX", 0))
+        page_features = [
+            feature(*parcel) for parcel in selected[start : start + int(query["COUNT"])]
+        ]
+        return web.json_response(
+            {
+                "type": "FeatureCollection",
+                "totalFeatures": len(selected),
+                "features": page_features,
+            }
+        )
+
+    def expected_keys(self):
+        return {key for index, (key, _) in enumerate(self.parcels) if index % 3}
+
+
+@pytest.fixture(autouse=True)
+def restore_url(monkeypatch):
+    # crawl points the module at the stand-in, undone after every test
+    monkeypatch.setattr(to_get_rice, "WFS_URL", to_get_rice.WFS_URL)
+
+
+async def crawl(server, json_dir, **options):
+    json_dir.mkdir(exist_ok=True)
+    app = web.Application()
+    app.router.add_get("/wfs", server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    to_get_rice.WFS_URL = f"http://127.0.0.1:{port}/wfs"
+    try:
+        await to_get_rice.fetch_rice_info(
+            "KEY", *BBOX, str(json_dir), rate=1000.0, backoff=0.01, **options
+        )
+    finally:
+        await runner.cleanup()
+
+
+def stored_keys(json_dir):
+    store = ParcelStore(str(json_dir / "parcels"))
+    keys = store["id"].tolist()
+    assert len(keys) == len(set(keys))
+    return set(keys)
+
+
+def test_paging_split_and_dedup(tmp_path):
+    server = StandInWfs()
+    asyncio.run(crawl(server, tmp_path))
+
+    pages = [page for page in server.requests if page[1] is not None]
+    # Only the cluster cell needs a second page.
+    assert [start for _, start in pages].count("1000") == 1
+    assert len({bbox for bbox, _ in pages}) > 4
+    assert stored_keys(tmp_path) == server.expected_keys()
+
+
+def test_retries_server_errors_and_throttling(tmp_path):
+    server = StandInWfs()
+    asyncio.run(crawl(server, tmp_path / "plan"))
+    pages = [page for page in server.requests if page[1] is not None]
+
+    server = StandInWfs()
+    server.fail_once.update(pages[:3])
+    server.throttle_once.update(pages[3:6])
+    asyncio.run(crawl(server, tmp_path / "run"))
+
+    for page in pages[:6]:
+        assert server.requests.count(page) == 2
+    assert stored_keys(tmp_path / "run") == server.expected_keys()
+
+
+def test_resume_fetches_only_missing_pages(tmp_path):
+    server = StandInWfs()
+    asyncio.run(crawl(server, tmp_path / "plan"))
+    paged = [page for page in server.requests if page[1] == "1000"]
+
+    server = StandInWfs()
+    server.broken.update(paged)
+    asyncio.run(crawl(server, tmp_path / "run", retries=0))
+    assert stored_keys(tmp_path / "run") < server.expected_keys()
+
+    server.broken.clear()
+    server.requests.clear()
+    asyncio.run(crawl(server, tmp_path / "run", retries=0, resume=True))
+    assert server.requests == paged
+    assert stored_keys(tmp_path / "run") == server.expected_keys()
+
+
+def test_new_plan_drops_pages_of_the_old_one(tmp_path):
+    region = [[126.0, 34.0], [126.04, 34.0], [126.04, 34.04], [126.0, 34.0]]
+    server = StandInWfs()
+    asyncio.run(crawl(server, tmp_path / "clean", regions=[region]))
+
+    asyncio.run(crawl(server, tmp_path / "run"))
+    asyncio.run(crawl(server, tmp_path / "run", regions=[region]))
+    assert stored_keys(tmp_path / "run") == stored_keys(tmp_path / "clean")
+
+
+def test_flaky_probe_is_retried(tmp_path):
+    server = StandInWfs()
+    server.fail_once.add(("34.1,126.1,34.2,126.2", None))
+    server.throttle_once.add(("34.1,126.0,34.2,126.1", None))
+    asyncio.run(crawl(server, tmp_path))
+    assert stored_keys(tmp_path) == server.expected_keys()
+
+
+def test_broken_probe_stops_the_plan_cleanly(tmp_path, capsys):
+    server = StandInWfs()
+    server.broken.add(("34.1,126.1,34.2,126.2", None))
+    asyncio.run(crawl(server, tmp_path, retries=1))
+    assert "Could not plan the crawl" in capsys.readouterr().out
+    assert server.requests.count(("34.1,126.1,34.2,126.2", None)) == 2
+    assert not (tmp_path / "parcels").exists()
+
+
+def test_failed_probe_leaves_no_partial_cache_file(tmp_path):
+    server = StandInWfs()
+    server.broken.add(("34.0,126.0,34.2,126.2", None))
+    asyncio.run(crawl(server, tmp_path / "run", retries=0, cache_dir=str(tmp_path)))
+    assert not list(tmp_path.glob("*/*.part"))
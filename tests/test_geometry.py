@@ -0,0 +1,79 @@
+import numpy as np
+from PIL import Image, ImageDraw
+from geometry import simplify_rings, crossing_segments
+from masks import burn_polygons, to_pixels
+
+PIXEL = 10 / 111320
+RESOLUTION = (256, 256)
+EXTENT = (126.0, 126.0 + 256 * PIXEL, 35.0, 35.0 + 256 * PIXEL)
+
+
+def wobbly_rings(count, seed=0):
+    rng = np.random.default_rng(seed)
+    rings = []
+    for _ in range(count):
+        size = rng.integers(40, 200)
+        center = np.array([EXTENT[0], EXTENT[2]]) + rng.uniform(0.05, 0.95, 2) * (
+            256 * PIXEL
+        )
+        angles = np.sort(rng.uniform(0, 2 * np.pi, size))
+        radii = rng.uniform(2, 15) * PIXEL
+        radii *= 1 + 0.3 * np.sin(5 * angles) + 0.05 * rng.standard_normal(size)
+        ring = (
+            center + np.column_stack([np.cos(angles), np.sin(angles)]) * radii[:, None]
+        )
+        rings.append(np.vstack([ring, ring[:1]]))
+    return rings
+
+
+def burn(rings):
+    ends = np.cumsum([len(ring) for ring in rings])
+    starts = ends - [len(ring) for ring in rings]
+    return burn_polygons(np.concatenate(rings), starts, ends, EXTENT, RESOLUTION)
+
+
+def outline_band(rings):
+    # Pixels on the outlines and their 4-neighbours
+    image = Image.new("L", RESOLUTION, 0)
+    draw = ImageDraw.Draw(image)
+    for ring in rings:
+        draw.line(to_pixels(ring, EXTENT, RESOLUTION).ravel().tolist(), fill=1)
+    band = np.pad(np.array(image) > 0, 1)
+    return (
+        band[1:-1, 1:-1]
+        | band[:-2, 1:-1]
+        | band[2:, 1:-1]
+        | band[1:-1, :-2]
+        | band[1:-1, 2:]
+    )
+
+
+def test_simplification_never_crosses_itself():
+    ring = np.array(
+        [[0, 0.5], [0, 0], [5, -0.2], [10, 0], [10, 0.5], [5, -0.1], [0, 0.5]]
+    )
+    for scale in (1e-5, 1e-4):
+        (simplified,) = simplify_rings([ring * scale], 2.5e-6 * scale / 1e-5)
+        assert not len(crossing_segments([simplified])[0])
+
+
+def test_holes_stay_inside():
+    # Dropping the bump would cut the exterior through the hole.
+    exterior = np.array(
+        [[0, 0], [4, 0], [4, 1.9], [4.3, 2], [4, 2.1], [4, 4], [0, 4], [0, 0]]
+    )
+    hole = np.array([[1, 1.95], [4.1, 1.98], [4.1, 2.02], [1, 2.05], [1, 1.95]])
+    simplified = simplify_rings([exterior, hole], 0.5)
+    assert len(simplified[0]) < len(exterior)
+    assert not any(len(segments) for segments in crossing_segments(simplified))
+
+
+def test_quarter_pixel_changes_only_outline_pixels():
+    rings = wobbly_rings(300)
+    simplified = [simplify_rings([ring], 0.25 * PIXEL)[0] for ring in rings]
+    assert sum(map(len, rings)) > 1.5 * sum(map(len, simplified))
+    assert not any(len(crossing_segments([ring])[0]) for ring in simplified)
+
+    changed = burn(rings) != burn(simplified)
+    assert changed.any()
+    assert not (changed & ~outline_band(rings)).any()
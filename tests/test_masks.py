@@ -0,0 +1,170 @@
+import os
+import json
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import masks
+from benchmark_masks import burn_one_by_one
+
+PIXEL = 0.0001
+ORIGIN = (126.0, 35.0)
+TILES = 3
+
+
+def write_tile(tiles_dir, number, seed=0):
+    row, col = divmod(number - 1, TILES)
+    transform = from_origin(
+        ORIGIN[0] + col * 128 * PIXEL, ORIGIN[1] - row * 128 * PIXEL, PIXEL, PIXEL
+    )
+    data = np.random.default_rng(number + seed).integers(
+        0, 255, (3, 128, 128), dtype=np.uint8
+    )
+    with rasterio.open(
+        os.path.join(tiles_dir, f"scene_{number}.tif"),
+        "w",
+        driver="GTiff",
+        height=128,
+        width=128,
+        count=3,
+        dtype="uint8",
+        crs="EPSG:4326",
+        transform=transform,
+    ) as dst:
+        dst.write(data)
+
+
+def random_parcels(count, seed=0):
+    # Star-shaped parcels anywhere in the scene, some crossing tile edges.
+    # The last tile is left empty so it goes to miscs.
+    rng = np.random.default_rng(seed)
+    span = TILES * 128 * PIXEL
+    parcels = []
+    while len(parcels) < count:
+        center = np.array([ORIGIN[0], ORIGIN[1]]) + rng.uniform(0, 1, 2) * [
+            span,
+            -span,
+        ]
+        if (
+            center[0] > ORIGIN[0] + 2 * span / 3
+            and center[1] < ORIGIN[1] - 2 * span / 3
+        ):
+            continue
+        size = rng.integers(3, 10)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, size))
+        radii = rng.uniform(2, 25, size) * PIXEL
+        ring = (
+            center + np.column_stack([np.cos(angles), np.sin(angles)]) * radii[:, None]
+        )
+        parcels.append(np.vstack([ring, ring[:1]]).tolist())
+    return parcels
+
+
+def write_responses(json_dir, parcels):
+    features = [
+        {
+            "type": "Feature",
+            "id": f"parcel.{index}",
+            "geometry": {"type": "MultiPolygon", "coordinates": [[ring]]},
+            "properties": {"pnu": str(index), "jibun": "1답"},
+        }
+        for index, ring in enumerate(parcels)
+    ]
+    with open(os.path.join(json_dir, "response_0.json"), "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def make_scene(tmp_path, parcels):
+    dirs = {name: tmp_path / name for name in ("tiles", "masks", "miscs", "json")}
+    for path in dirs.values():
+        path.mkdir(parents=True)
+    for number in range(1, TILES * TILES + 1):
+        write_tile(dirs["tiles"], number)
+    write_responses(dirs["json"], parcels)
+    return {name: str(path) for name, path in dirs.items()}
+
+
+def reference_mask(image_path, parcels):
+    # The original per-polygon path: one image per parcel fully inside the tile
+    with rasterio.open(image_path) as src:
+        extent = masks.plotting_extent(src)
+        resolution = (src.width, src.height)
+    inside = [
+        ring
+        for ring in map(np.asarray, parcels)
+        if ring[:, 0].min() >= extent[0]
+        and ring[:, 0].max() <= extent[1]
+        and ring[:, 1].min() >= extent[2]
+        and ring[:, 1].max() <= extent[3]
+    ]
+    return burn_one_by_one(inside, extent, resolution) if inside else None
+
+
+def read_mask(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+def test_masks_match_per_polygon_burn(tmp_path):
+    parcels = random_parcels(300)
+    for workers in (1, 2):
+        dirs = make_scene(tmp_path / f"workers_{workers}", parcels)
+        masks.draw_polygons(
+            dirs["tiles"], dirs["masks"], dirs["miscs"], dirs["json"], workers=workers
+        )
+
+        for image_file in sorted(os.listdir(dirs["tiles"])):
+            expected = reference_mask(os.path.join(dirs["tiles"], image_file), parcels)
+            mask_path = os.path.join(dirs["masks"], image_file)
+            misc_path = os.path.join(dirs["miscs"], image_file)
+            if expected is None:
+                assert os.path.exists(misc_path) and not os.path.exists(mask_path)
+            else:
+                assert not os.path.exists(misc_path)
+                assert np.array_equal(read_mask(mask_path), expected)
+        assert os.listdir(dirs["miscs"]) == [f"scene_{TILES * TILES}.tif"]
+
+
+def test_rerun_redraws_only_changed_tiles(tmp_path, monkeypatch):
+    parcels = random_parcels(300)
+    dirs = make_scene(tmp_path, parcels)
+    drawn = []
+    draw = masks.TileRasterizer.draw
+
+    def recording_draw(self, image_path, *paths):
+        drawn.append(os.path.basename(image_path))
+        return draw(self, image_path, *paths)
+
+    monkeypatch.setattr(masks.TileRasterizer, "draw", recording_draw)
+
+    def rerun():
+        drawn.clear()
+        masks.draw_polygons(dirs["tiles"], dirs["masks"], dirs["miscs"], dirs["json"])
+        return sorted(drawn)
+
+    assert len(rerun()) == TILES * TILES
+    assert rerun() == []
+
+    # New pixels in tile 1, a new parcel in tile 5 and a deleted mask in tile 8
+    write_tile(dirs["tiles"], 1, seed=100)
+    center = (
+        ORIGIN[0] + 1.5 * 128 * PIXEL,
+        ORIGIN[1] - 1.5 * 128 * PIXEL,
+    )
+    parcels.append(
+        [
+            [center[0], center[1]],
+            [center[0] + 5 * PIXEL, center[1]],
+            [center[0], center[1] + 5 * PIXEL],
+            [center[0], center[1]],
+        ]
+    )
+    write_responses(dirs["json"], parcels)
+    masks.shutil.rmtree(os.path.join(dirs["json"], "parcels"))
+    os.remove(os.path.join(dirs["masks"], "scene_8.tif"))
+
+    assert rerun() == ["scene_1.tif", "scene_5.tif", "scene_8.tif"]
+    assert np.array_equal(
+        read_mask(os.path.join(dirs["masks"], "scene_5.tif")),
+        reference_mask(os.path.join(dirs["tiles"], "scene_5.tif"), parcels),
+    )
+    assert rerun() == []
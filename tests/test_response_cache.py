@@ -0,0 +1,37 @@
+from response_cache import ResponseCache
+
+
+def page(bbox, count=1000):
+    return {"TYPENAME": "lp_pa_cbnd_bubun", "BBOX": bbox, "COUNT": count}
+
+
+def store(cache, payload, release=""):
+    entry = cache.lookup(payload)
+    assert not entry.hit
+    entry.write(b"{}")
+    entry.commit(release)
+
+
+def test_months_of_one_release_stay_fresh(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    store(cache, page("1,1,2,2"), "2023")
+    store(cache, page("2,2,3,3"), "2023")
+    cache.close()
+
+    cache = ResponseCache(str(tmp_path))
+    assert cache.lookup(page("1,1,2,2")).hit
+    assert cache.lookup(page("2,2,3,3")).hit
+
+
+def test_new_release_expires_pages_and_probes(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    store(cache, page("1,1,2,2"), "2023")
+    store(cache, page("1,1,2,2", count=1))
+    store(cache, page("2,2,3,3"), "2024")
+    cache.close()
+
+    cache = ResponseCache(str(tmp_path))
+    assert cache.release == "2024"
+    assert not cache.lookup(page("1,1,2,2")).hit
+    assert not cache.lookup(page("1,1,2,2", count=1)).hit
+    assert cache.lookup(page("2,2,3,3")).hit
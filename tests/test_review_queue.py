@@ -0,0 +1,41 @@
+from review_queue import ReviewQueue
+
+
+def test_failed_item_goes_to_the_back_and_is_parked(tmp_path):
+    queue = ReviewQueue(str(tmp_path / "queue.sqlite"))
+    queue.sync(["a.png", "b.png", "c.png"])
+
+    claimed = []
+    while (filename := queue.claim_next(1)) is not None:
+        claimed.append(filename)
+        if filename == "a.png":
+            queue.fail(filename, 1, OSError("corrupt tile"))
+        else:
+            assert queue.finish(filename, 1, "kept")
+
+    assert claimed == ["a.png", "b.png", "c.png", "a.png", "a.png"]
+    assert queue.items("failed") == ["a.png"]
+
+
+def test_failed_later_item_stays_later(tmp_path):
+    queue = ReviewQueue(str(tmp_path / "queue.sqlite"))
+    queue.sync(["a.png", "b.png"])
+    queue.claim_next(1)
+    queue.finish("a.png", 1, "later")
+    assert queue.claim_next(1, states=("later",)) == "a.png"
+    queue.fail("a.png", 1, "send failed", state="later")
+    assert queue.items("later") == ["a.png"]
+    assert queue.claim_next(2) == "b.png"
+
+
+def test_deferring_again_cycles_through_later_items(tmp_path):
+    queue = ReviewQueue(str(tmp_path / "queue.sqlite"))
+    queue.sync(["a.png", "b.png", "c.png"])
+    while (filename := queue.claim_next(1)) is not None:
+        queue.finish(filename, 1, "later")
+
+    claimed = []
+    for _ in range(4):
+        claimed.append(queue.claim_next(1, states=("later",)))
+        queue.finish(claimed[-1], 1, "later")
+    assert claimed == ["a.png", "b.png", "c.png", "a.png"]
@@ -0,0 +1,280 @@
+import os
+import json
+import zlib
+import shutil
+import argparse
+import functools
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+
+TILE_SHAPE = (3, 128, 128)
+MASK_SHAPE = (1, 128, 128)
+
+# A store is a directory with one <name>.bin per array (tiles, masks), made of
+# chunks of chunk_size consecutive tiles that are zlib-compressed on their own,
+# with <name>_offsets.npy holding the byte offset of every chunk. The side
+# table is one .npy column per field (transforms, scenes, indices) and
+# meta.json holds the CRS and the shape, dtype and chunking of every array.
+
+
+class ArrayWriter:
+    def __init__(
+        self,
+        store_dir,
+        name,
+        shape,
+        dtype=np.uint8,
+        chunk_size=64,
+        compression="zlib",
+    ):
+        self.store_dir = store_dir
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.data_path = os.path.join(store_dir, name + ".bin")
+        self.data_file = open(self.data_path + ".tmp", "wb")
+        self.offsets = [0]
+        self.buffer = []
+        self.count = 0
+
+    def append(self, array):
+        array = np.asarray(array, dtype=self.dtype)
+        if array.shape != self.shape:
+            raise ValueError(f"Expected a {self.shape} array, got {array.shape}")
+        self.buffer.append(array)
+        self.count += 1
+        if len(self.buffer) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = np.stack(self.buffer).tobytes()
+        if self.compression == "zlib":
+            chunk = zlib.compress(chunk, 6)
+        self.data_file.write(chunk)
+        self.offsets.append(self.offsets[-1] + len(chunk))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.data_file.close()
+        os.replace(self.data_path + ".tmp", self.data_path)
+        np.save(
+            os.path.join(self.store_dir, f"{self.name}_offsets.npy"),
+            np.array(self.offsets, dtype=np.int64),
+        )
+        return {
+            "count": self.count,
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "chunk_size": self.chunk_size,
+            "compression": self.compression,
+        }
+
+
+class TileStoreWriter:
+    def __init__(self, store_dir, crs, chunk_size=64, compression="zlib"):
+        self.store_dir = store_dir
+        self.tmp_dir = store_dir.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.crs = crs
+        self.tiles = ArrayWriter(
+            self.tmp_dir,
+            "tiles",
+            TILE_SHAPE,
+            chunk_size=chunk_size,
+            compression=compression,
+        )
+        self.transforms = []
+        self.scenes = []
+        self.indices = []
+
+    def append(self, tile, transform, scene, index):
+        self.tiles.append(tile)
+        self.transforms.append(tuple(transform)[:6])
+        self.scenes.append(scene)
+        self.indices.append(index)
+
+    def close(self):
+        info = self.tiles.close()
+        np.save(
+            os.path.join(self.tmp_dir, "transforms.npy"),
+            np.array(self.transforms, dtype=np.float64).reshape(-1, 6),
+        )
+        np.save(
+            os.path.join(self.tmp_dir, "scenes.npy"), np.array(self.scenes, dtype=str)
+        )
+        np.save(
+            os.path.join(self.tmp_dir, "indices.npy"),
+            np.array(self.indices, dtype=np.int64),
+        )
+        save_meta(
+            self.tmp_dir,
+            {"crs": str(self.crs), "count": info["count"], "arrays": {"tiles": info}},
+        )
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+        os.rename(self.tmp_dir, self.store_dir)
+
+
+def load_meta(store_dir):
+    with open(os.path.join(store_dir, "meta.json")) as f:
+        return json.load(f)
+
+
+def save_meta(store_dir, meta):
+    with open(os.path.join(store_dir, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(
+        os.path.join(store_dir, "meta.json.tmp"), os.path.join(store_dir, "meta.json")
+    )
+
+
+def add_array(store_dir, name, arrays, shape, dtype=np.uint8, chunk_size=64):
+    # Adds an array aligned row by row with the tiles, e.g. the masks.
+    meta = load_meta(store_dir)
+    writer = ArrayWriter(store_dir, name, shape, dtype=dtype, chunk_size=chunk_size)
+    for array in arrays:
+        writer.append(array)
+    info = writer.close()
+    if info["count"] != meta["count"]:
+        raise ValueError(f"{name} has {info['count']} rows, expected {meta['count']}")
+    meta["arrays"][name] = info
+    save_meta(store_dir, meta)
+
+
+class ChunkedArray:
+    def __init__(self, store_dir, name, info, cache_chunks=8):
+        self.tile_shape = tuple(info["shape"])
+        self.shape = (info["count"], *self.tile_shape)
+        self.dtype = np.dtype(info["dtype"])
+        self.chunk_size = info["chunk_size"]
+        self.compression = info["compression"]
+        self.offsets = np.load(os.path.join(store_dir, f"{name}_offsets.npy"))
+        data_path = os.path.join(store_dir, name + ".bin")
+        if os.path.getsize(data_path):
+            self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.empty(0, dtype=np.uint8)
+        # Uncompressed stores are read straight from the memory map.
+        self.raw = None
+        if self.compression == "none":
+            self.raw = self.data.view(self.dtype).reshape(self.shape)
+        self.chunk = functools.lru_cache(maxsize=cache_chunks)(self.read_chunk)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_chunk(self, number):
+        block = self.data[self.offsets[number] : self.offsets[number + 1]]
+        if self.compression == "zlib":
+            block = np.frombuffer(zlib.decompress(block), dtype=np.uint8)
+        return block.view(self.dtype).reshape(-1, *self.tile_shape)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.read(np.arange(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if self.raw is not None:
+            return self.raw[index]
+        return self.chunk(index // self.chunk_size)[index % self.chunk_size]
+
+    def read(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.raw is not None:
+            return self.raw[indices]
+        batch = np.empty((len(indices), *self.tile_shape), dtype=self.dtype)
+        chunks = indices // self.chunk_size
+        for number in np.unique(chunks):
+            selected = chunks == number
+            batch[selected] = self.chunk(int(number))[
+                indices[selected] % self.chunk_size
+            ]
+        return batch
+
+    def batches(self, batch_size=256):
+        for start in range(0, len(self), batch_size):
+            yield self.read(np.arange(start, min(start + batch_size, len(self))))
+
+
+class TileStore:
+    def __init__(self, store_dir, cache_chunks=8):
+        self.store_dir = store_dir
+        self.meta = load_meta(store_dir)
+        self.crs = self.meta["crs"]
+        self.transforms = np.load(os.path.join(store_dir, "transforms.npy"))
+        self.scenes = np.load(os.path.join(store_dir, "scenes.npy"))
+        self.indices = np.load(os.path.join(store_dir, "indices.npy"))
+        self.arrays = {
+            name: ChunkedArray(store_dir, name, info, cache_chunks)
+            for name, info in self.meta["arrays"].items()
+        }
+        self.tiles = self.arrays["tiles"]
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def transform(self, row):
+        return Affine(*self.transforms[row])
+
+    def name(self, row):
+        return f"{self.scenes[row]}_{self.indices[row]}"
+
+    def export(self, out_dir, array="tiles", batch_size=256):
+        os.makedirs(out_dir, exist_ok=True)
+        values = self.arrays[array]
+        row = 0
+        for batch in values.batches(batch_size):
+            for data in batch:
+                with rasterio.open(
+                    os.path.join(out_dir, self.name(row) + ".tif"),
+                    "w",
+                    driver="GTiff",
+                    height=data.shape[1],
+                    width=data.shape[2],
+                    count=data.shape[0],
+                    dtype=data.dtype,
+                    crs=self.crs,
+                    transform=self.transform(row),
+                ) as dst:
+                    dst.write(data)
+                row += 1
+        print(f"Exported {row} {array} from {self.store_dir} to {out_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--store_dir",
+        type=str,
+        required=True,
+        help="Path to the Tile Store, e.g. ./data/tiles/<safe>.tiles",
+    )
+    parser.add_argument(
+        "-o",
+        "--out_dir",
+        type=str,
+        required=True,
+        help="Directory to write the GeoTIFFs to",
+    )
+    parser.add_argument(
+        "-a",
+        "--array",
+        type=str,
+        default="tiles",
+        help="Array to export, tiles or masks",
+    )
+    args = parser.parse_args()
+
+    TileStore(args.store_dir).export(args.out_dir, array=args.array)
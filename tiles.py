@@ -2,11 +2,19 @@ import os
 import glob
 import json
 import argparse
+import contextlib
 import rasterio
-import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from osgeo import gdal
 from rasterio.windows import Window
+from rasterio.enums import Resampling
+from geometry import convex_hull, ring_intersects_bbox
+from tile_store import TileStoreWriter
+from band_cache import BandCache
+
+gdal.UseExceptions()
 
 
 def get_bbox(tiff_path):
@@ -38,20 +46,65 @@ def write_band(band, reference_path, output_path):
     out_dataset = None
 
 
-def hist_stretching(band, lower_percentile=2, upper_percentile=98, gamma=1.0):
-    non_black_mask = band > 0
-    non_black_band = band[non_black_mask]
-    p_lower, p_upper = np.percentile(
-        non_black_band, (lower_percentile, upper_percentile)
-    )
-    band_stretched = np.zeros_like(band, dtype=np.float32)
-    band_stretched[non_black_mask] = np.clip(
-        (band[non_black_mask] - p_lower) * 255.0 / (p_upper - p_lower), 0, 255
+def band_histogram(band, block_rows=1024):
+    histogram = np.zeros(65536, dtype=np.int64)
+    for row in range(0, band.shape[0], block_rows):
+        histogram += np.bincount(band[row : row + block_rows].ravel(), minlength=65536)
+    return histogram
+
+
+def histogram_percentiles(histogram, percentiles):
+    # Same linear interpolation between order statistics as np.percentile,
+    # with the order statistics looked up in the cumulative histogram.
+    cumulative = np.cumsum(histogram)
+    count = cumulative[-1]
+    virtual = (count - 1) * (np.asarray(percentiles, dtype=np.float64) / 100)
+    lower = np.floor(virtual)
+    fraction = virtual - lower
+    a = np.searchsorted(cumulative, lower, side="right").astype(np.float64)
+    b = np.searchsorted(
+        cumulative, np.minimum(lower + 1, count - 1), side="right"
+    ).astype(np.float64)
+    diff = b - a
+    return np.where(fraction >= 0.5, b - diff * (1 - fraction), a + diff * fraction)
+
+
+def stretch_lut(p_lower, p_upper, gamma=1.0):
+    values = np.arange(65536, dtype=np.uint16)
+    lut = np.clip((values - p_lower) * 255.0 / (p_upper - p_lower), 0, 255).astype(
+        np.float32
     )
-    band_stretched[non_black_mask] = (
-        np.power(band_stretched[non_black_mask] / 255.0, gamma) * 255
+    lut = (np.power(lut / 255.0, gamma) * 255).astype(np.uint8)
+    lut[0] = 0
+    return lut
+
+
+def hist_stretching(
+    band,
+    lower_percentile=2,
+    upper_percentile=98,
+    gamma=1.0,
+    block_rows=1024,
+    histogram=None,
+):
+    # Sentinel-2 bands are uint16, so the percentiles of the non-black pixels
+    # come from a 65536-bin histogram and the stretch is a uint16 -> uint8
+    # lookup table applied block by block. The output is the same as clipping
+    # and gamma-correcting the pixels in float32.
+    if histogram is None:
+        histogram = band_histogram(band, block_rows)
+    histogram = histogram.copy()
+    histogram[0] = 0
+    if not histogram.any():
+        return np.zeros_like(band, dtype=np.uint8)
+    p_lower, p_upper = histogram_percentiles(
+        histogram, (lower_percentile, upper_percentile)
     )
-    return band_stretched.astype(np.uint8)
+    lut = stretch_lut(p_lower, p_upper, gamma)
+    band_stretched = np.empty(band.shape, dtype=np.uint8)
+    for row in range(0, band.shape[0], block_rows):
+        band_stretched[row : row + block_rows] = lut[band[row : row + block_rows]]
+    return band_stretched
 
 
 def crop_black_borders(image_path, cropped_image_path):
@@ -94,125 +147,353 @@ def crop_black_borders(image_path, cropped_image_path):
         return True
 
 
-def process_directories(
-    refs_dir, tiles_dir, sentinel_dir, gamma=1.0, agriculture=False
-):
-    for safe_dir in os.listdir(sentinel_dir):
-        safe_path = os.path.join(sentinel_dir, safe_dir)
-        if not os.path.isdir(safe_path):
-            continue
-
-        if agriculture:
-            band_1_path = glob.glob(safe_path + "*/*/*/*/*/*B11_20m.jp2")[0]
-            band_2_path = glob.glob(safe_path + "*/*/*/*/*/*B08_10m.jp2")[0]
-            band_3_path = glob.glob(safe_path + "*/*/*/*/*/*B02_10m.jp2")[0]
-        else:
-            band_1_path = glob.glob(safe_path + "*/*/*/*/*/*B04_10m.jp2")[0]
-            band_2_path = glob.glob(safe_path + "*/*/*/*/*/*B03_10m.jp2")[0]
-            band_3_path = glob.glob(safe_path + "*/*/*/*/*/*B02_10m.jp2")[0]
+# A 10980x10980 uint16 band plus its uint8 stretch
+BAND_BYTES = 10980 * 10980 * 3
 
-        band_1 = read_band(band_1_path)
-        band_2 = read_band(band_2_path)
-        band_3 = read_band(band_3_path)
+band_slots = None
+band_cache_config = None
 
-        band_1_hs = hist_stretching(band_1, gamma=gamma)
-        band_2_hs = hist_stretching(band_2, gamma=gamma)
-        band_3_hs = hist_stretching(band_3, gamma=gamma)
 
-        new_band_1_path = os.path.join(
-            os.path.dirname(band_1_path),
-            os.path.basename(band_1_path).replace(".jp2", "_band_1.tif"),
-        )
-        new_band_2_path = os.path.join(
-            os.path.dirname(band_2_path),
-            os.path.basename(band_2_path).replace(".jp2", "_band_2.tif"),
-        )
-        new_band_3_path = os.path.join(
-            os.path.dirname(band_3_path),
-            os.path.basename(band_3_path).replace(".jp2", "_band_3.tif"),
-        )
+def default_band_slots():
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 3
+    return max(1, int(available * 0.75) // BAND_BYTES)
+
+
+def init_worker(slots, threads, band_cache=None):
+    global band_slots, band_cache_config
+    band_slots = slots
+    band_cache_config = band_cache
+    gdal.SetConfigOption("GDAL_NUM_THREADS", str(threads))
+
+
+def write_cog(band, reference_path, output_path):
+    dataset = gdal.Open(reference_path, gdal.GA_ReadOnly)
+    mem_dataset = gdal.GetDriverByName("MEM").Create(
+        "", dataset.RasterXSize, dataset.RasterYSize, 1, gdal.GDT_UInt16
+    )
+    mem_dataset.SetGeoTransform(dataset.GetGeoTransform())
+    mem_dataset.SetProjection(dataset.GetProjection())
+    mem_dataset.GetRasterBand(1).WriteArray(band)
+    gdal.Translate(
+        output_path,
+        mem_dataset,
+        format="COG",
+        creationOptions=[
+            "COMPRESS=DEFLATE",
+            "PREDICTOR=2",
+            "BLOCKSIZE=512",
+            "OVERVIEWS=NONE",
+            "NUM_THREADS=ALL_CPUS",
+        ],
+    )
 
-        write_band(band_1_hs, band_1_path, new_band_1_path)
-        write_band(band_2_hs, band_2_path, new_band_2_path)
-        write_band(band_3_hs, band_3_path, new_band_3_path)
-
-        ref_filename = os.path.basename(band_3_path).replace("_B02_10m.jp2", ".tif")
-        ref_path = os.path.join(refs_dir, ref_filename)
-        vrt_path = ref_path.replace(".tif", ".vrt")
-        wgs_path = ref_path.replace(".tif", "_wgs84.tif")
-
-        subprocess.run(
-            [
-                "gdalbuildvrt",
-                "-separate",
-                vrt_path,
-                new_band_1_path,
-                new_band_2_path,
-                new_band_3_path,
-            ]
+
+def load_band(safe_id, band_path):
+    # Returns the decoded band and its histogram, from the band cache when it
+    # is enabled, so a rerun with another gamma skips the JPEG2000 decoding.
+    if band_cache_config is None:
+        band = read_band(band_path)
+        return band, band_histogram(band)
+
+    band_cache = BandCache(*band_cache_config)
+    try:
+        cached = band_cache.lookup(safe_id, band_path)
+        if cached:
+            cog_path, histogram_path = cached
+            return read_band(cog_path), np.load(histogram_path)
+
+        band = read_band(band_path)
+        histogram = band_histogram(band)
+        cog_path, histogram_path = band_cache.paths(
+            band_cache.make_key(safe_id, band_path)
         )
-        subprocess.run(["gdal_translate", "-of", "GTiff", vrt_path, ref_path])
-        subprocess.run(
-            ["gdalwarp", "-t_srs", "EPSG:4326", ref_path, wgs_path], check=True
+        os.makedirs(os.path.dirname(cog_path), exist_ok=True)
+        write_cog(band, band_path, cog_path)
+        np.save(histogram_path, histogram)
+        band_cache.store(safe_id, band_path)
+        return band, histogram
+    finally:
+        band_cache.close()
+
+
+def stretch_band(safe_id, band_path, stretched_path, gamma):
+    # band_slots is shared by every scene process, so no more than that many
+    # full-resolution bands are decoded and stretched at the same time.
+    with band_slots:
+        band, histogram = load_band(safe_id, band_path)
+        band_hs = hist_stretching(band, gamma=gamma, histogram=histogram)
+        write_band(band_hs, band_path, stretched_path)
+
+
+def process_safe(
+    safe_path,
+    refs_dir,
+    tiles_dir,
+    gamma,
+    agriculture,
+    threads,
+    max_nodata,
+    tile_store=False,
+):
+    safe_dir = os.path.basename(safe_path)
+    if agriculture:
+        band_1_path = glob.glob(safe_path + "*/*/*/*/*/*B11_20m.jp2")[0]
+        band_2_path = glob.glob(safe_path + "*/*/*/*/*/*B08_10m.jp2")[0]
+        band_3_path = glob.glob(safe_path + "*/*/*/*/*/*B02_10m.jp2")[0]
+    else:
+        band_1_path = glob.glob(safe_path + "*/*/*/*/*/*B04_10m.jp2")[0]
+        band_2_path = glob.glob(safe_path + "*/*/*/*/*/*B03_10m.jp2")[0]
+        band_3_path = glob.glob(safe_path + "*/*/*/*/*/*B02_10m.jp2")[0]
+
+    # The stretched bands only live in /vsimem and are stacked by an
+    # in-memory VRT, which is warped straight into the final reference
+    # GeoTIFF, so the only file written per scene is ref_path.
+    vsimem_dir = f"/vsimem/{safe_dir}"
+    stretched_paths = []
+    for number, band_path in enumerate(
+        (band_1_path, band_2_path, band_3_path), start=1
+    ):
+        stretched_paths.append(
+            os.path.join(
+                vsimem_dir,
+                os.path.basename(band_path).replace(".jp2", f"_band_{number}.tif"),
+            )
+        )
+    with ThreadPoolExecutor(3) as executor:
+        list(
+            executor.map(
+                stretch_band,
+                [safe_dir] * 3,
+                (band_1_path, band_2_path, band_3_path),
+                stretched_paths,
+                [gamma] * 3,
+            )
         )
 
-        os.remove(ref_path)
-        os.remove(vrt_path)
-        os.remove(new_band_1_path)
-        os.remove(new_band_2_path)
-        os.remove(new_band_3_path)
-        os.rename(wgs_path, ref_path)
-
-        y_min, x_min, y_max, x_max = get_bbox(ref_path)
-        metadata = {
-            "tif_wgs_output_path": ref_path,
-            "bbox": {"y_min": y_min, "x_min": x_min, "y_max": y_max, "x_max": x_max},
-        }
-        json_path = os.path.join(refs_dir, ref_filename.replace(".tif", ".json"))
-        with open(json_path, "w") as json_file:
-            json.dump(metadata, json_file, indent=4)
-
-        tile_output_dir = os.path.join(tiles_dir, ref_filename.split(".")[0])
+    ref_filename = os.path.basename(band_3_path).replace("_B02_10m.jp2", ".tif")
+    ref_path = os.path.join(refs_dir, ref_filename)
+    vrt_path = os.path.join(vsimem_dir, ref_filename.replace(".tif", ".vrt"))
+
+    vrt = gdal.BuildVRT(vrt_path, stretched_paths, separate=True)
+    gdal.Warp(
+        ref_path,
+        vrt,
+        format="GTiff",
+        dstSRS="EPSG:4326",
+        multithread=True,
+        warpOptions=[f"NUM_THREADS={threads}"],
+    )
+    vrt = None
+    for path in stretched_paths + [vrt_path]:
+        gdal.Unlink(path)
+
+    y_min, x_min, y_max, x_max = get_bbox(ref_path)
+    footprint = valid_footprint(ref_path)
+    metadata = {
+        "tif_wgs_output_path": ref_path,
+        "bbox": {"y_min": y_min, "x_min": x_min, "y_max": y_max, "x_max": x_max},
+        "footprint": footprint,
+    }
+    json_path = os.path.join(refs_dir, ref_filename.replace(".tif", ".json"))
+    with open(json_path, "w") as json_file:
+        json.dump(metadata, json_file, indent=4)
+
+    tile_output_dir = os.path.join(tiles_dir, ref_filename.split(".")[0])
+    windows = tile_windows(ref_path, max_nodata=max_nodata, footprint=footprint)
+    if tile_store:
+        write_tile_store(ref_path, tile_output_dir + ".tiles", windows)
+    else:
         os.makedirs(tile_output_dir, exist_ok=True)
-        subprocess.run(
-            [
-                "gdal_retile.py",
-                "-ps",
-                "128",
-                "128",
-                "-targetDir",
-                tile_output_dir,
-                ref_path,
-            ],
-            check=True,
+        write_tiles(ref_path, tile_output_dir, windows)
+
+
+def valid_footprint(ref_path, overview_size=512):
+    # Convex hull of the non-black pixels of a low-resolution overview, as a
+    # closed [lon, lat] ring. The overview mask is grown by one pixel and the
+    # hull goes around whole overview pixels, so it never cuts off valid data.
+    with rasterio.open(ref_path) as src:
+        scale = max(1.0, max(src.width, src.height) / overview_size)
+        height = int(np.ceil(src.height / scale))
+        width = int(np.ceil(src.width / scale))
+        overview = src.read(
+            out_shape=(src.count, height, width), resampling=Resampling.average
+        )
+        transform = src.transform * src.transform.scale(
+            src.width / width, src.height / height
         )
 
-        target_shape = (3, 128, 128)
-        for filename in os.listdir(tile_output_dir):
-            if filename.endswith(".tif") or filename.endswith(".tiff"):
-                file_path = os.path.join(tile_output_dir, filename)
-                try:
-                    with rasterio.open(file_path) as dataset:
-                        data = dataset.read()
-                        if data.shape != target_shape:
-                            print(
-                                f"Removing {filename}, shape {data.shape} does not match {target_shape}"
-                            )
-                            os.remove(file_path)
-                        else:
-                            print(f"Keeping {filename}, shape matches {target_shape}")
-                except Exception as e:
-                    print(f"Error reading {filename}: {e}")
-                    continue
-
-        tiles = glob.glob(os.path.join(tile_output_dir, "*.tif"))
-        tiles.sort()
-        for idx, tile in enumerate(tiles, start=1):
-            new_name = os.path.join(
-                tile_output_dir,
-                f"{os.path.basename(ref_path).replace('.tif', '')}_{idx}.tif",
+    valid = (overview > 0).any(axis=0)
+    grown = valid.copy()
+    grown[1:] |= valid[:-1]
+    grown[:-1] |= valid[1:]
+    grown[:, 1:] |= valid[:, :-1]
+    grown[:, :-1] |= valid[:, 1:]
+    rows = np.flatnonzero(grown.any(axis=1))
+    if not len(rows):
+        return []
+    first = grown[rows].argmax(axis=1)
+    last = width - 1 - grown[rows][:, ::-1].argmax(axis=1)
+    corners = np.concatenate(
+        [
+            np.column_stack([first, rows]),
+            np.column_stack([first, rows + 1]),
+            np.column_stack([last + 1, rows]),
+            np.column_stack([last + 1, rows + 1]),
+        ]
+    )
+    xs, ys = transform * (corners[:, 0], corners[:, 1])
+    return convex_hull(np.column_stack([xs, ys]))
+
+
+def tile_windows(ref_path, tile_size=128, max_nodata=0.5, footprint=None):
+    # Only full tile_size windows are kept, and only when at most max_nodata
+    # of their pixels are black in every band (the border of the warped scene)
+    # and they intersect the footprint.
+    windows = []
+    with rasterio.open(ref_path) as src:
+        rows, cols = src.height // tile_size, src.width // tile_size
+        transform = src.transform
+        for row in range(rows):
+            strip = src.read(
+                window=Window(0, row * tile_size, cols * tile_size, tile_size)
+            )
+            nodata = (
+                (strip == 0)
+                .all(axis=0)
+                .reshape(tile_size, cols, tile_size)
+                .mean(axis=(0, 2))
+            )
+            for col in np.flatnonzero(nodata <= max_nodata):
+                if footprint:
+                    x_min, y_max = transform * (col * tile_size, row * tile_size)
+                    x_max, y_min = transform * (
+                        (col + 1) * tile_size,
+                        (row + 1) * tile_size,
+                    )
+                    if not ring_intersects_bbox(
+                        footprint, (y_min, x_min, y_max, x_max)
+                    ):
+                        continue
+                windows.append((row, col))
+    print(
+        f"Keeping {len(windows)} of {rows * cols} tiles of {os.path.basename(ref_path)}"
+    )
+    return windows
+
+
+def write_tiles(ref_path, tile_output_dir, windows, tile_size=128):
+    base_name = os.path.basename(ref_path).replace(".tif", "")
+    for filename in os.listdir(tile_output_dir):
+        if filename.startswith(base_name + "_") and filename.endswith(".tif"):
+            os.remove(os.path.join(tile_output_dir, filename))
+
+    rows = {}
+    for idx, (row, col) in enumerate(windows, start=1):
+        rows.setdefault(row, []).append((idx, col))
+
+    def write_row(row, tiles):
+        with rasterio.open(ref_path) as src:
+            strip = src.read(window=Window(0, row * tile_size, src.width, tile_size))
+            profile = {
+                "driver": "GTiff",
+                "height": tile_size,
+                "width": tile_size,
+                "count": src.count,
+                "dtype": src.dtypes[0],
+                "crs": src.crs,
+                "nodata": src.nodata,
+            }
+            for idx, col in tiles:
+                window = Window(col * tile_size, row * tile_size, tile_size, tile_size)
+                with rasterio.open(
+                    os.path.join(tile_output_dir, f"{base_name}_{idx}.tif"),
+                    "w",
+                    transform=src.window_transform(window),
+                    **profile,
+                ) as dst:
+                    dst.write(strip[:, :, col * tile_size : (col + 1) * tile_size])
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(write_row, rows.keys(), rows.values()))
+
+
+def write_tile_store(ref_path, store_dir, windows, tile_size=128):
+    scene = os.path.basename(ref_path).replace(".tif", "")
+    with rasterio.open(ref_path) as src:
+        writer = TileStoreWriter(store_dir, src.crs.to_wkt())
+        strip_row, strip = None, None
+        for idx, (row, col) in enumerate(windows, start=1):
+            if row != strip_row:
+                strip_row = row
+                strip = src.read(
+                    window=Window(0, row * tile_size, src.width, tile_size)
+                )
+            window = Window(col * tile_size, row * tile_size, tile_size, tile_size)
+            writer.append(
+                strip[:, :, col * tile_size : (col + 1) * tile_size],
+                src.window_transform(window),
+                scene,
+                idx,
             )
-            os.rename(tile, new_name)
+        writer.close()
+    print(f"Wrote {len(windows)} tiles to {store_dir}")
+
+
+def run_safe(task):
+    safe_path = task[0]
+    try:
+        process_safe(*task)
+    except Exception as e:
+        print(f"Failed to process {os.path.basename(safe_path)}: {e!r}")
+        with contextlib.suppress(RuntimeError):
+            gdal.RmdirRecursive(f"/vsimem/{os.path.basename(safe_path)}")
+        return safe_path
+    return None
+
+
+def process_directories(
+    refs_dir,
+    tiles_dir,
+    sentinel_dir,
+    gamma=1.0,
+    agriculture=False,
+    threads="ALL_CPUS",
+    workers=1,
+    max_bands=None,
+    max_nodata=0.5,
+    tile_store=False,
+    band_cache=None,
+):
+    tasks = [
+        (
+            os.path.join(sentinel_dir, safe_dir),
+            refs_dir,
+            tiles_dir,
+            gamma,
+            agriculture,
+            threads,
+            max_nodata,
+            tile_store,
+        )
+        for safe_dir in sorted(os.listdir(sentinel_dir))
+        if os.path.isdir(os.path.join(sentinel_dir, safe_dir))
+    ]
+    slots = multiprocessing.BoundedSemaphore(max_bands or default_band_slots())
+    if workers > 1:
+        with multiprocessing.Pool(
+            workers, initializer=init_worker, initargs=(slots, threads, band_cache)
+        ) as pool:
+            failed = [path for path in pool.imap_unordered(run_safe, tasks) if path]
+    else:
+        init_worker(slots, threads, band_cache)
+        failed = [path for path in map(run_safe, tasks) if path]
+
+    print(f"Processed {len(tasks) - len(failed)} of {len(tasks)} scenes")
+    for path in failed:
+        print(f"Failed: {path}")
 
 
 if __name__ == "__main__":
@@ -245,6 +526,53 @@ if __name__ == "__main__":
         default=None,
         help="Whether to use bands for agriculture monitoring",
     )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=str,
+        default="ALL_CPUS",
+        help="Threads GDAL uses for decoding and warping a scene",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of scenes processed in parallel",
+    )
+    parser.add_argument(
+        "-b",
+        "--max_bands",
+        type=int,
+        default=None,
+        help="Full-resolution bands in memory at once, defaults to what fits in RAM",
+    )
+    parser.add_argument(
+        "-n",
+        "--max_nodata",
+        type=float,
+        default=0.5,
+        help="Skip tiles with a larger fraction of black pixels, 1.0 keeps all",
+    )
+    parser.add_argument(
+        "-o",
+        "--tile_store",
+        action="store_true",
+        help="Write the tiles of a scene into one chunked <scene>.tiles store",
+    )
+    parser.add_argument(
+        "-c",
+        "--band_cache",
+        type=str,
+        default=None,
+        help="Directory to cache decoded bands in, defaults to <data_path>/band_cache",
+    )
+    parser.add_argument(
+        "--band_cache_gb",
+        type=float,
+        default=20.0,
+        help="Size limit of the band cache in GB, 0 disables it",
+    )
 
     args = parser.parse_args()
 
@@ -261,4 +589,17 @@ if __name__ == "__main__":
         sentinel_dir=args.sentinel_dir,
         gamma=args.gamma,
         agriculture=args.agr,
+        threads=args.threads,
+        workers=args.workers,
+        max_bands=args.max_bands,
+        max_nodata=args.max_nodata,
+        tile_store=args.tile_store,
+        band_cache=(
+            (
+                args.band_cache or os.path.join(args.data_path, "band_cache"),
+                int(args.band_cache_gb * 1024**3),
+            )
+            if args.band_cache_gb > 0
+            else None
+        ),
     )
@@ -1,17 +1,18 @@
 import os
-import gc
 import json
+import asyncio
+import random
 import argparse
-import urllib.request as req
-from urllib.parse import urlencode
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from manifest import CrawlManifest
+from response_cache import ResponseCache
+from rate_limit import RateLimiter, QuotaExceededError
+from telemetry import FetchTelemetry
+from parcel_store import ParcelColumns, save_page, build_store
+from wfs_client import WFS_URL, WfsClient, FeatureParser
+from geometry import ring_intersects_bbox
 
 
-def get_total_features(
-    AUTH_KEY: str, y_min: str, x_min: str, y_max: str, x_max: str
-) -> int:
-    url = "https://api.vworld.kr/req/wfs"
-
+async def count_features(client, AUTH_KEY, y_min, x_min, y_max, x_max) -> int:
     payload = {
         "SERVICE": "WFS",
         "REQUEST": "GetFeature",
@@ -26,64 +27,248 @@ def get_total_features(
         "KEY": AUTH_KEY,
     }
 
-    apiurl = url + "?" + urlencode(payload)
-    response = req.urlopen(apiurl).read().decode("utf-8")
-    data = json.loads(response)
-    return data["totalFeatures"]
+    entry = client.cache.lookup(payload) if client.cache else None
+    if entry and entry.hit:
+        client.telemetry.count("cache_hits")
+        body = entry.read()
+    else:
+        try:
+            body = await client.fetch(payload)
+        except BaseException:
+            if entry:
+                entry.abort()
+            raise
+        if entry:
+            entry.write(body)
+            entry.commit()
+    return json.loads(body)["totalFeatures"]
+
+
+async def count_cell(client, AUTH_KEY, bbox, retries=3, backoff=2.0) -> int:
+    # Probes are retried on their own, so one flaky count does not lose the plan.
+    for attempt in range(retries + 1):
+        try:
+            return await count_features(client, AUTH_KEY, *bbox)
+        except QuotaExceededError:
+            raise
+        except Exception as exc:
+            if attempt == retries:
+                raise
+            delay = backoff * 2**attempt * random.uniform(0.5, 1.5)
+            print(
+                f"Retrying count for cell {bbox} in {delay:.1f}s "
+                f"({attempt + 1}/{retries}): {exc}"
+            )
+            await asyncio.sleep(delay)
+
+
+def get_total_features(
+    AUTH_KEY: str, y_min: str, x_min: str, y_max: str, x_max: str
+) -> int:
+    async def probe():
+        async with WfsClient() as client:
+            return await count_features(client, AUTH_KEY, y_min, x_min, y_max, x_max)
+
+    return asyncio.run(probe())
+
+
+def is_rice_paddy(feature):
+    properties = feature["properties"]
+    return bool(
+        properties.get("jibun")
+        and "답" in properties["jibun"]
+        or properties.get("bonbun")
+        and "답" in properties["bonbun"]
+    )
+
+
+def feature_release(feature):
+    return feature["properties"].get("gosi_year") or ""
+
 
+def feature_key(feature):
+    return feature.get("id") or feature["properties"].get("pnu")
 
-def fetch_data(url, payload):
-    apiurl = url + "?" + urlencode(payload)
-    response = req.urlopen(apiurl).read().decode("utf-8")
-    data = json.loads(response)
 
-    filtered_features = [
-        feature
-        for feature in data["features"]
-        if feature["properties"].get("jibun")
-        and "답" in feature["properties"]["jibun"]
-        or feature["properties"].get("bonbun")
-        and "답" in feature["properties"]["bonbun"]
+# Degrees per 10 m Sentinel-2 pixel, used to turn --simplify into a tolerance
+PIXEL_DEGREES = 10 / 111320
+
+
+class ResponseWriter:
+    def __init__(self, json_dir, file_number, grid=None, tolerance=None):
+        self.file_path = os.path.join(json_dir, f"response_{file_number}.npz")
+        self.grid = grid
+        self.tolerance = tolerance
+        self.columns = ParcelColumns(grid, tolerance)
+
+    @property
+    def file_features(self):
+        return len(self.columns)
+
+    def write(self, feature):
+        self.columns.append(feature)
+
+    def close(self, header):
+        if not self.file_features:
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+            print("No filtered features found. Skipping saving the page.")
+            return
+        part_path = self.file_path + ".part"
+        save_page(part_path, self.columns.to_arrays())
+        os.replace(part_path, self.file_path)
+        print(f"Filtered response saved successfully as {self.file_path}")
+
+    def discard(self):
+        self.columns = ParcelColumns(self.grid, self.tolerance)
+
+
+async def fetch_data(client, payload, writer, seen):
+    parser = FeatureParser()
+    entry = client.cache.lookup(payload) if client.cache else None
+    claimed = []
+    byte_count = 0
+    feature_count = 0
+    release = ""
+    try:
+        if entry and entry.hit:
+            client.telemetry.count("cache_hits")
+            source = entry.replay()
+        else:
+            source = client.stream(payload)
+        async with source as chunks:
+            async for chunk in chunks:
+                byte_count += len(chunk)
+                if entry:
+                    entry.write(chunk)
+                for feature in parser.feed(chunk):
+                    feature_count += 1
+                    release = max(release, feature_release(feature))
+                    key = feature_key(feature)
+                    if is_rice_paddy(feature) and key not in seen:
+                        seen.add(key)
+                        claimed.append(key)
+                        writer.write(feature)
+        header = parser.close()
+    except BaseException:
+        seen.difference_update(claimed)
+        writer.discard()
+        if entry:
+            entry.abort()
+        raise
+
+    if entry:
+        entry.commit(release)
+    client.telemetry.count("features_downloaded", feature_count)
+    client.telemetry.count("features_kept", len(claimed))
+    writer.close(header)
+    return header, byte_count, feature_count
+
+
+def split_bbox(bbox):
+    y_min, x_min, y_max, x_max = bbox
+    y_mid = (y_min + y_max) / 2
+    x_mid = (x_min + x_max) / 2
+    return [
+        (y_min, x_min, y_mid, x_mid),
+        (y_min, x_mid, y_mid, x_max),
+        (y_mid, x_min, y_max, x_mid),
+        (y_mid, x_mid, y_max, x_max),
     ]
 
-    return data, filtered_features
-
-
-def save_filtered_data(data, filtered_features, start_index, json_dir):
-    if filtered_features:
-        filtered_data = {
-            "type": data["type"],
-            "totalFeatures": data["totalFeatures"],
-            "fileFeatures": len(filtered_features),
-            "features": filtered_features,
-        }
-        file_path = os.path.join(json_dir, f"response_{start_index // 1000}.json")
-        with open(file_path, "w") as json_file:
-            json.dump(filtered_data, json_file, indent=4, ensure_ascii=False)
-        print(f"Filtered response saved successfully as {file_path}")
-    else:
-        print("No filtered features found. Skipping saving the JSON file.")
 
+def covers(bbox, regions):
+    # regions are convex [lon, lat] rings, e.g. scene footprints
+    return regions is None or any(
+        ring_intersects_bbox(region, bbox) for region in regions
+    )
 
-def get_rice_info(
+
+async def gather_all(*awaitables):
+    # Like asyncio.gather, but lets every probe finish before re-raising the
+    # first error, so none is left running when the crawl gives up.
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def plan_cells(
+    client,
+    AUTH_KEY,
+    bbox,
+    max_features,
+    max_depth=10,
+    depth=0,
+    total=None,
+    regions=None,
+    retries=3,
+    backoff=2.0,
+):
+    if not covers(bbox, regions):
+        return []
+    if total is None:
+        total = await count_cell(client, AUTH_KEY, bbox, retries, backoff)
+    if total == 0:
+        return []
+    if total <= max_features or depth == max_depth:
+        return [(bbox, total)]
+
+    quadrants = [quadrant for quadrant in split_bbox(bbox) if covers(quadrant, regions)]
+    counts = await gather_all(
+        *(
+            count_cell(client, AUTH_KEY, quadrant, retries, backoff)
+            for quadrant in quadrants
+        )
+    )
+    plans = await gather_all(
+        *(
+            plan_cells(
+                client,
+                AUTH_KEY,
+                quadrant,
+                max_features,
+                max_depth=max_depth,
+                depth=depth + 1,
+                total=count,
+                regions=regions,
+                retries=retries,
+                backoff=backoff,
+            )
+            for quadrant, count in zip(quadrants, counts)
+        )
+    )
+    return [cell for plan in plans for cell in plan]
+
+
+async def fetch_rice_info(
     AUTH_KEY: str,
     y_min: str,
     x_min: str,
     y_max: str,
     x_max: str,
     json_dir: str,
-    start_index=0,
+    max_workers=16,
+    pages_per_cell=1,
+    retries=5,
+    backoff=2.0,
+    resume=False,
+    cache_dir=None,
+    regions=None,
+    rate=10.0,
+    daily_budget=None,
+    quota_file=None,
+    metrics_file=None,
+    snap_grid=None,
+    simplify=None,
 ) -> None:
-    url = "https://api.vworld.kr/req/wfs"
     features_per_request = 1000
-    total_features = get_total_features(
-        AUTH_KEY=AUTH_KEY, y_min=y_min, x_min=x_min, y_max=y_max, x_max=x_max
-    )
+    tolerance = simplify * PIXEL_DEGREES if simplify else None
     payload_template = {
         "SERVICE": "WFS",
         "REQUEST": "GetFeature",
         "TYPENAME": "lp_pa_cbnd_bubun",
-        "BBOX": f"{y_min},{x_min},{y_max},{x_max}",
         "PROPERTYNAME": "pnu,jibun,bchk,std_sggcd,bubun,bonbun,addr,gosi_year,gosi_month,jiga,ag_geom",
         "VERSION": "2.0.0",
         "COUNT": features_per_request,
@@ -93,23 +278,163 @@ def get_rice_info(
         "KEY": AUTH_KEY,
     }
 
-    def fetch_and_save(start):
-        payload = {**payload_template, "STARTINDEX": start}
-        try:
-            data, filtered_features = fetch_data(url, payload)
-            save_filtered_data(data, filtered_features, start, json_dir)
-            del data, filtered_features
-            gc.collect()
-        except Exception as exc:
-            print(f"Failed to fetch data for start index {start}: {str(exc)}")
+    manifest = CrawlManifest(os.path.join(json_dir, "manifest.sqlite"))
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    release = cache.release if cache else ""
+    limiter = RateLimiter(rate=rate, daily_budget=daily_budget, state_path=quota_file)
+    telemetry = FetchTelemetry()
+    telemetry_path = os.path.join(json_dir, "telemetry.json")
+    metrics_file = metrics_file or os.path.join(json_dir, "telemetry.prom")
+    async with WfsClient(
+        url=WFS_URL,
+        max_workers=max_workers,
+        cache=cache,
+        limiter=limiter,
+        telemetry=telemetry,
+    ) as client:
+        bbox = (float(y_min), float(x_min), float(y_max), float(x_max))
+        bbox_key = json.dumps([bbox, regions])
+        if resume and manifest.get_meta("bbox") == bbox_key:
+            print(f"Resuming crawl from manifest: {manifest.summary()}")
+        else:
+            try:
+                cells = await plan_cells(
+                    client,
+                    AUTH_KEY,
+                    bbox,
+                    max_features=features_per_request * pages_per_cell,
+                    regions=regions,
+                    retries=retries,
+                    backoff=backoff,
+                )
+            except Exception as exc:
+                print(f"Could not plan the crawl: {exc!r}")
+                if cache:
+                    cache.close()
+                manifest.close()
+                return
+            pages = [
+                (cell, start)
+                for cell, total in cells
+                for start in range(0, total, features_per_request)
+            ]
+            manifest.reset(bbox_key, pages)
+            print(f"Planned {len(cells)} cells with {len(pages)} pages in total.")
+
+        seen = set()
+        completed = 0
+
+        async def fetch_and_save(file_number, cell, start):
+            payload = {
+                **payload_template,
+                "BBOX": ",".join(str(value) for value in cell),
+                "STARTINDEX": start,
+            }
+            writer = ResponseWriter(json_dir, file_number, snap_grid, tolerance)
+            try:
+                header, byte_count, feature_count = await fetch_data(
+                    client, payload, writer, seen
+                )
+            except Exception as exc:
+                print(f"Failed to fetch data for cell {cell} at {start}: {str(exc)}")
+                manifest.mark(file_number, "failed", error=str(exc))
+                return
+
+            manifest.mark(
+                file_number,
+                "done" if writer.file_features else "empty",
+                byte_count=byte_count,
+                feature_count=feature_count,
+                kept_count=writer.file_features,
+            )
+            nonlocal completed
+            completed += 1
+            if completed % 50 == 0:
+                print(limiter.status(len(manifest.pages())))
+                telemetry.write(telemetry_path, metrics_file)
+
+        for attempt in range(retries + 1):
+            pending = manifest.pages()
+            if not pending:
+                break
+            print(limiter.status(len(pending)))
+            if limiter.exhausted:
+                break
+            if attempt:
+                delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                print(
+                    f"Retrying {len(pending)} failed pages in {delay:.1f}s "
+                    f"({attempt}/{retries})"
+                )
+                await asyncio.sleep(delay)
+            await asyncio.gather(*(fetch_and_save(*page) for page in pending))
+
+    print(f"Crawl finished: {manifest.summary()}")
+    telemetry.write(telemetry_path, metrics_file)
+    summary = telemetry.summary()
+    print(
+        f"{summary['requests']} requests ({summary['retries']} retries), "
+        f"{summary['downloaded_bytes'] / 1024**2:.1f} MiB, "
+        f"{summary['features_per_second']} features/s, "
+        f"kept ratio {summary['kept_ratio']}, telemetry saved to {telemetry_path}"
+    )
+    build_store(
+        json_dir,
+        file_numbers=[page[0] for page in manifest.pages(states=("done",))],
+    )
+    if cache:
+        cache.report()
+        if release and cache.release != release:
+            print(
+                "The crawl was planned with counts cached for the previous data "
+                "release, rerun without --resume to plan it again."
+            )
+        cache.close()
+    if manifest.pages():
+        print("Some pages are still missing, rerun with --resume to fetch them.")
+    manifest.close()
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [
-            executor.submit(fetch_and_save, i)
-            for i in range(start_index, total_features, features_per_request)
-        ]
-        for future in as_completed(futures):
-            future.result()
+
+def get_rice_info(
+    AUTH_KEY: str,
+    y_min: str,
+    x_min: str,
+    y_max: str,
+    x_max: str,
+    json_dir: str,
+    max_workers=16,
+    pages_per_cell=1,
+    resume=False,
+    cache_dir=None,
+    regions=None,
+    rate=10.0,
+    daily_budget=None,
+    quota_file=None,
+    metrics_file=None,
+    snap_grid=None,
+    simplify=None,
+) -> None:
+    asyncio.run(
+        fetch_rice_info(
+            AUTH_KEY,
+            y_min=y_min,
+            x_min=x_min,
+            y_max=y_max,
+            x_max=x_max,
+            json_dir=json_dir,
+            max_workers=max_workers,
+            pages_per_cell=pages_per_cell,
+            resume=resume,
+            cache_dir=cache_dir,
+            regions=regions,
+            rate=rate,
+            daily_budget=daily_budget,
+            quota_file=quota_file,
+            metrics_file=metrics_file,
+            snap_grid=snap_grid,
+            simplify=simplify,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -156,6 +481,69 @@ if __name__ == "__main__":
         required=True,
         help="Path to Directory to Save JSON Files",
     )
+    parser.add_argument(
+        "-w",
+        "--max_workers",
+        type=int,
+        default=16,
+        help="Upper Bound of Concurrent Requests to V-World",
+    )
+    parser.add_argument(
+        "-p",
+        "--pages_per_cell",
+        type=int,
+        default=1,
+        help="Split the BBOX until every cell fits into this many pages",
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="Fetch only the pages the crawl manifest still lists as missing",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Path to Directory to Cache V-World Responses Across Runs",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="Maximum Number of Requests per Second to V-World",
+    )
+    parser.add_argument(
+        "--daily_budget",
+        type=int,
+        default=None,
+        help="Maximum Number of Requests per Day for the Authentication Key",
+    )
+    parser.add_argument(
+        "--quota_file",
+        type=str,
+        default=None,
+        help="Path to JSON File Counting the Requests Used Today",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="Path to Prometheus .prom File, e.g. in the node_exporter Textfile Directory",
+    )
+    parser.add_argument(
+        "--snap_grid",
+        type=float,
+        default=None,
+        help="Snap Parcel Coordinates to Multiples of this many Degrees, e.g. 1e-6",
+    )
+    parser.add_argument(
+        "--simplify",
+        type=float,
+        default=None,
+        help="Simplify Parcel Rings to this Fraction of a 10 m Pixel, e.g. 0.25",
+    )
     args = parser.parse_args()
 
     get_rice_info(
@@ -165,4 +553,14 @@ if __name__ == "__main__":
         y_max=args.y_max,
         x_max=args.x_max,
         json_dir=args.json_dir,
+        max_workers=args.max_workers,
+        pages_per_cell=args.pages_per_cell,
+        resume=args.resume,
+        cache_dir=args.cache_dir,
+        rate=args.rate,
+        daily_budget=args.daily_budget,
+        quota_file=args.quota_file,
+        metrics_file=args.metrics_file,
+        snap_grid=args.snap_grid,
+        simplify=args.simplify,
     )
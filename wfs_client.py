@@ -0,0 +1,266 @@
+import re
+import json
+import time
+import asyncio
+import aiohttp
+import contextlib
+from urllib.parse import urlencode
+from rate_limit import RateLimiter, QuotaExceededError
+from telemetry import FetchTelemetry
+
+WFS_URL = "https://api.vworld.kr/req/wfs"
+
+
+EXCEPTION_CODE = re.compile(r'(?:exceptionCode|code)\s*=\s*"([^"]+)"')
+QUOTA_CODES = ("OVER_REQUEST_LIMIT",)
+BUSY_CODES = ("SYSTEM_ERROR", "UNKNOWN_ERROR")
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class WfsServiceError(Exception):
+    pass
+
+
+def exception_code(body):
+    for code in QUOTA_CODES + BUSY_CODES:
+        if code in body:
+            return code
+    match = EXCEPTION_CODE.search(body)
+    return match.group(1) if match else ""
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+class AdaptiveWindow:
+    # AIMD in-flight window: grows by roughly one slot per window of requests
+    # while latency stays near its baseline, shrinks on slowdowns and halves
+    # on errors (5xx, timeouts, dropped connections).
+    def __init__(self, initial=4, minimum=1, maximum=16, tolerance=2.0):
+        self.size = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.baseline = None
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.size))
+            self.in_flight += 1
+
+    async def release(self, latency=None):
+        async with self.condition:
+            self.in_flight -= 1
+            if latency is None:
+                self.size = max(self.minimum, self.size / 2)
+            elif self.baseline is None or latency <= self.baseline * self.tolerance:
+                self.baseline = (
+                    latency
+                    if self.baseline is None
+                    else 0.9 * self.baseline + 0.1 * latency
+                )
+                self.size = min(self.maximum, self.size + 1 / int(self.size))
+            else:
+                self.size = max(self.minimum, self.size - 1)
+            self.condition.notify_all()
+
+
+class WfsClient:
+    def __init__(
+        self,
+        url=WFS_URL,
+        max_workers=16,
+        timeout=120,
+        retries=3,
+        cache=None,
+        limiter=None,
+        max_throttles=20,
+        telemetry=None,
+    ):
+        self.url = url
+        self.cache = cache
+        self.limiter = limiter or RateLimiter()
+        self.telemetry = telemetry or FetchTelemetry()
+        self.max_throttles = max_throttles
+        self.timeout = timeout
+        self.retries = retries
+        self.window = AdaptiveWindow(initial=min(4, max_workers), maximum=max_workers)
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.window.maximum, keepalive_timeout=90, ttl_dns_cache=300
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=[self.telemetry.trace_config()],
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.limiter.save()
+        await self.session.close()
+
+    async def open(self, payload):
+        apiurl = self.url + "?" + urlencode(payload)
+        attempt = 0
+        throttles = 0
+        while True:
+            await self.limiter.acquire()
+            await self.window.acquire()
+            started = time.monotonic()
+            self.telemetry.count("requests")
+            try:
+                response = await self.session.get(apiurl)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                error = exc
+            else:
+                latency = time.monotonic() - started
+                if response.status < 400 and "xml" not in response.content_type:
+                    self.limiter.recover()
+                    return response, started
+
+                body = await response.text(errors="replace")
+                response.release()
+                code = exception_code(body)
+                throttled = response.status == 429 or (
+                    response.status == 503 and retry_after(response) is not None
+                )
+                if throttled and throttles < self.max_throttles:
+                    await self.window.release(latency)
+                    self.limiter.throttle(retry_after(response))
+                    self.telemetry.count("throttles")
+                    throttles += 1
+                    continue
+                if code in QUOTA_CODES:
+                    await self.window.release(latency)
+                    self.limiter.exhaust()
+                    self.telemetry.count("failures")
+                    raise QuotaExceededError(f"V-World rejected the request: {code}")
+                if response.status < 500 and code not in BUSY_CODES:
+                    await self.window.release(latency)
+                    self.telemetry.count("failures")
+                    raise WfsServiceError(
+                        f"HTTP {response.status}: {code or body[:200].strip()}"
+                    )
+                error = ServerBusyError(f"HTTP {response.status} {code}".strip())
+
+            await self.window.release()
+            if attempt == self.retries:
+                self.telemetry.count("failures")
+                raise error
+            attempt += 1
+            self.telemetry.count("retries")
+            print(f"Retrying request ({attempt}/{self.retries}): {error}")
+            await asyncio.sleep(2 ** (attempt - 1))
+
+    @contextlib.asynccontextmanager
+    async def stream(self, payload, chunk_size=65536):
+        response, started = await self.open(payload)
+
+        async def chunks():
+            async for chunk in response.content.iter_chunked(chunk_size):
+                self.telemetry.count("downloaded_bytes", len(chunk))
+                yield chunk
+
+        try:
+            yield chunks()
+        except BaseException:
+            self.telemetry.count("failures")
+            await self.window.release()
+            raise
+        else:
+            latency = time.monotonic() - started
+            self.telemetry.latency["total"].observe(latency)
+            await self.window.release(latency)
+        finally:
+            response.release()
+
+    async def fetch(self, payload):
+        async with self.stream(payload) as chunks:
+            return b"".join([chunk async for chunk in chunks])
+
+
+class FeatureParser:
+    # Incremental splitter for a GeoJSON FeatureCollection. Raw body chunks are
+    # fed in and every element of the top-level "features" array is decoded as
+    # soon as its closing brace arrives; everything else is kept as a small
+    # header document with an empty features array.
+    TOKENS = re.compile(rb'[\[\]{}"\\]')
+    FEATURES_KEY = re.compile(rb'"features"\s*:\s*$')
+
+    def __init__(self):
+        self.buffer = b""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.skip_until = 0
+        self.in_features = False
+        self.feature_start = None
+        self.header = bytearray()
+        self.copy_from = 0
+
+    def feed(self, chunk):
+        features = []
+        self.buffer += chunk
+        for match in self.TOKENS.finditer(self.buffer, self.position):
+            index = match.start()
+            if index < self.skip_until:
+                continue
+            token = match.group()
+            if token == b"\\":
+                self.skip_until = index + 2
+            elif token == b'"':
+                self.in_string = not self.in_string
+            elif self.in_string:
+                continue
+            elif token in b"[{":
+                self.depth += 1
+                if self.in_features and self.depth == 3 and token == b"{":
+                    self.feature_start = index
+                elif not self.in_features and self.depth == 2 and token == b"[":
+                    self.header += self.buffer[self.copy_from : index]
+                    self.copy_from = index
+                    if self.FEATURES_KEY.search(self.header[-64:]):
+                        self.in_features = True
+                        self.header += b"["
+                        self.copy_from = None
+            else:
+                if self.in_features and self.depth == 3 and token == b"}":
+                    features.append(
+                        json.loads(self.buffer[self.feature_start : index + 1])
+                    )
+                    self.feature_start = None
+                self.depth -= 1
+                if self.in_features and self.depth == 1:
+                    self.in_features = False
+                    self.copy_from = index
+
+        self.position = len(self.buffer)
+        if self.copy_from is not None:
+            self.header += self.buffer[self.copy_from :]
+            self.copy_from = self.position
+        keep_from = (
+            self.feature_start if self.feature_start is not None else self.position
+        )
+        self.buffer = self.buffer[keep_from:]
+        self.position -= keep_from
+        self.skip_until -= keep_from
+        if self.feature_start is not None:
+            self.feature_start = 0
+        if self.copy_from is not None:
+            self.copy_from -= keep_from
+        return features
+
+    def close(self):
+        return json.loads(self.header)